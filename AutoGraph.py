@@ -6,27 +6,44 @@
 
 import numpy as np
 from pandas import DataFrame, read_csv
+from scipy.sparse import issparse
 import os, sys
 from random import sample
 
 if __name__ == '__main__':
 #if True:
     from lib.functions import *
-    from lib.rmsd import rmsd, assign_remaining_files, rmsdMatrix
+    from lib.rmsd import rmsd, assign_remaining_files, cachedRmsdMatrix, rmsdNeighbors
+    from lib.conformerCache import resolveCacheDir
+    from lib.export import save_outputs, exportReport
+    from lib.communityIndex import CommunityIndex
     from lib.LouvainClustering import Louvain
+    from lib.LeidenClustering import Leiden
+    from lib.consensusClustering import multiStartClustering, consensusPartition, clusterStability
+    from lib.resolutionSweep import resolutionSweep
     from lib.findThreshold import findThreshold
     from lib.select_centroids import centroid_energy, centroid_weighted_degree, centroid_eccentricity, centroid_betweenness
+    from lib.matrixStore import writeMatrix, writeSparseMatrix
 else:
     from .lib.functions import *
-    from .lib.rmsd import rmsd, assign_remaining_files, rmsdMatrix
+    from .lib.rmsd import rmsd, assign_remaining_files, cachedRmsdMatrix, rmsdNeighbors
+    from .lib.conformerCache import resolveCacheDir
+    from .lib.export import save_outputs, exportReport
+    from .lib.communityIndex import CommunityIndex
     from .lib.LouvainClustering import Louvain
+    from .lib.LeidenClustering import Leiden
+    from .lib.consensusClustering import multiStartClustering, consensusPartition, clusterStability
+    from .lib.resolutionSweep import resolutionSweep
     from .lib.findThreshold import findThreshold
     from .lib.select_centroids import centroid_energy, centroid_weighted_degree, centroid_eccentricity, centroid_betweenness
+    from .lib.matrixStore import writeMatrix, writeSparseMatrix
+
+communityDetectionMethods = {'louvain': Louvain, 'leiden': Leiden}
 
 class AutoGraph:
     '''AutoGraph: Autonomous graph based conformational clustering.\n'''
-    def __init__(self, randomize = False, subset = 0, copy_conformers = True, silence = False, hetatm = True, centroid_selection='betweenness'):
-        '''randomize: (Boolean) shuffle file order\nsubset: (int) perform protocol only on a randomly sampled subset\ncopy_conformers: {Boolean) save clustered conformer files together in a dedicated directory\nsilence: (Boolean) ignore print statements\nhetatom: (Boolean) if PDB is read, consider coordinates for HETATM as well as ATOM'''
+    def __init__(self, randomize = False, subset = 0, copy_conformers = True, silence = False, hetatm = True, centroid_selection='betweenness', n_jobs = 1, matrix_dtype = 'float64', write_csv = False, sparse = False, rmsd_cutoff = 2.0, cache_dir = None, export_mode = 'copy', community_detection = 'louvain', n_starts = 1, seed = None, centrality_cutoff = 2000, centrality_pivots = 512):
+        '''randomize: (Boolean) shuffle file order\nsubset: (int) perform protocol only on a randomly sampled subset\ncopy_conformers: {Boolean) save clustered conformer files together in a dedicated directory\nsilence: (Boolean) ignore print statements\nhetatom: (Boolean) if PDB is read, consider coordinates for HETATM as well as ATOM\nn_jobs: (int) number of processes for computing the RMSD matrix and selecting centroids. -1 uses all cores\nmatrix_dtype: (string) precision of the saved matrices, "float64" or "float32"\nwrite_csv: (Boolean) also export the RMSD and affinity matrices as csv files\nsparse: (Boolean) build only the graph of conformer pairs within rmsd_cutoff and keep all matrices in scipy.sparse format. Memory scales with the number of edges\nrmsd_cutoff: (float) RMSD (Angstrom) above which pairs are dropped in sparse mode. Must be large enough for the graph to be connected\ncache_dir: (string) directory of the parsed coordinate and RMSD cache shared by all clustering methods. None (default) disables the cache, '' uses $XDG_CACHE_HOME/autograph (~/.cache/autograph)\nexport_mode: (string) how conformers are saved in the cluster directories when copy_conformers is True. "copy", "hardlink", "symlink", or "tar" / "zip" for one archive per cluster\ncommunity_detection: (string) algorithm clustering the filtered graph, "louvain" or "leiden"\nn_starts: (int) number of runs of community detection with different node orders on the same graph. If above 1, the clusters are the consensus of the runs, and their stability is reported\nseed: (int) seed of the node orders when n_starts > 1, and of the sampled pivots of approximate betweenness (0 if None)\ncentrality_cutoff: (int) number of members above which eccentricity and betweenness centroids are approximated. None never approximates\ncentrality_pivots: (int) number of searches from sampled members (betweenness) or bounding searches (eccentricity) in approximated clusters. The error of each approximated centroid is reported'''
         self.randomize = randomize
         self.subset = subset
         self.copy_conformers = copy_conformers
@@ -34,10 +51,24 @@ class AutoGraph:
         self.hetatm = hetatm
         self.threshold = 0.0
         self.centroid_selection = centroid_selection
+        self.n_jobs = n_jobs
+        self.matrix_dtype = matrix_dtype
+        self.write_csv = write_csv
+        self.sparse = sparse
+        self.rmsd_cutoff = rmsd_cutoff
+        self.cache_dir = cache_dir
+        self.export_mode = export_mode
+        self.community_detection = community_detection
+        self.n_starts = n_starts
+        self.seed = seed
+        self.stability = None
+        self.centrality_cutoff = centrality_cutoff
+        self.centrality_pivots = centrality_pivots
+        self.centralityErrors = None
 
     def formatPaths(self, inpath, outpath):
-        '''Append "/" to path endings if not present.'''
-        if inpath[-1] != '/':
+        '''Append "/" to path endings if not present. A multi-frame input file is left as is.'''
+        if inpath[-1] != '/' and not isEnsemble(inpath):
             inpath = inpath + '/'
         if outpath[-1] != '/':
             outpath = outpath + '/'
@@ -46,11 +77,11 @@ class AutoGraph:
     def set_up(self, inpath, outpath):
         '''Set up the output directory and read input data'''
         inpath, outpath = self.formatPaths(inpath, outpath)
-        self.master_fileList = [x for x in os.listdir(inpath) if x[-3:] in ['xyz', 'pdb', 'mol']]
+        self.master_fileList = listConformers(inpath)
         self.sample_fileList = self.master_fileList
         self.numFiles = len(self.sample_fileList)
         if not os.path.exists(outpath):
-            os.system('mkdir ' + outpath)
+            os.makedirs(outpath)
         if self.subset > 0:
             self.sample_fileList = sample(self.master_fileList, self.subset)
             self.sample_fileList = sample(self.master_fileList, self.subset)
@@ -58,37 +89,33 @@ class AutoGraph:
         elif self.randomize:
             self.sample_fileList = sample(self.master_fileList, self.numFiles)
         self.rmsdMatrix = None
+        self.communityIndex = None
         self.affinityMatrix = None
-        if 'rmsdMatrix.csv' in os.listdir(outpath) and self.subset == 0:
-            self.rmsdMatrix = read_csv(outpath + 'rmsdMatrix.csv', index_col = 0)
-            self.rmsdMatrix = self.rmsdMatrix.reindex(index = self.sample_fileList, columns = self.sample_fileList)
-            self.rmsdMatrix = self.rmsdMatrix.to_numpy()
-
-        if 'affinityMatrix.csv' in os.listdir(outpath) and self.subset == 0:
-            self.affinityMatrix = read_csv(outpath + 'affinityMatrix.csv', index_col = 0)
-            self.affinityMatrix = self.affinityMatrix.reindex(index = self.sample_fileList, columns = self.sample_fileList)
-            self.affinityMatrix = self.affinityMatrix.to_numpy()
 
     def getRmsdMatrix(self, inpath, outpath):
-        '''If RMSD matrix has not been read, compute and save it'''
+        '''Read the RMSD matrix cached in outpath, computing only the pairs involving new or modified files, and save it'''
         inpath, outpath = self.formatPaths(inpath, outpath)
-        if type(self.rmsdMatrix) == type(None):
-            self.rmsdMatrix = rmsdMatrix(self.sample_fileList, inpath, self.hetatm)
-            rmsdDf = DataFrame(self.rmsdMatrix, index = self.sample_fileList, columns = self.sample_fileList)
-            with open(outpath + 'rmsdMatrix.csv', 'w') as g:
-                rmsdDf.to_csv(g)
-            del rmsdDf
-
-    def getAffinityMatrix(self, inpath, outpath):
-        '''If affinity matrix has not been read, compute and save it'''
+        if type(self.rmsdMatrix) == type(None) and self.sparse:
+            self.rmsdMatrix, numPruned = rmsdNeighbors(self.sample_fileList, inpath, self.rmsd_cutoff, self.hetatm, cache_dir = resolveCacheDir(self.cache_dir))
+            writeSparseMatrix(outpath + 'rmsdGraph', self.rmsdMatrix, self.sample_fileList, self.matrix_dtype)
+            if not self.silence:
+                print('RMSD pairs within cutoff: %d, pairs pruned by pivots: %d' %(self.rmsdMatrix.nnz // 2, numPruned))
+        elif type(self.rmsdMatrix) == type(None):
+            self.rmsdMatrix = cachedRmsdMatrix(self.sample_fileList, inpath, outpath + 'rmsdMatrix', self.hetatm, self.n_jobs, self.matrix_dtype, self.write_csv, resolveCacheDir(self.cache_dir))
+
+    def getAffinityMatrix(self, inpath, outpath, save = True):
+        '''Compute the affinity matrix from the RMSD matrix and save it unless save is False'''
         inpath, outpath = self.formatPaths(inpath, outpath)
-        if type(self.affinityMatrix) == type(None):
+        if type(self.affinityMatrix) == type(None) and issparse(self.rmsdMatrix):
+            self.affinityMatrix = self.rmsdMatrix.copy()
+            self.affinityMatrix.data = rbfKernel(self.affinityMatrix.data)
+            if save:
+                writeSparseMatrix(outpath + 'affinityMatrix', self.affinityMatrix, self.sample_fileList, self.matrix_dtype)
+        elif type(self.affinityMatrix) == type(None):
             self.affinityMatrix = rbfKernel(self.rmsdMatrix)
             self.affinityMatrix[range(self.numFiles), range(self.numFiles)] = 0
-            affinityDf = DataFrame(self.affinityMatrix, index = self.sample_fileList, columns = self.sample_fileList)
-            with open(outpath + 'affinityMatrix.csv', 'w') as h:
-                affinityDf.to_csv(h)
-            del affinityDf
+            if save:
+                writeMatrix(outpath + 'affinityMatrix', self.affinityMatrix, self.sample_fileList, self.matrix_dtype, self.write_csv)
 
     def getThreshold(self):
         '''Compute the maximum threshold to have exactly one component.'''
@@ -98,51 +125,102 @@ class AutoGraph:
                 print('threshold: %f' %self.threshold)
                 print('threshold RMSD: %f' %( np.sqrt(-np.log(self.threshold)) ))
 
-    def getFilteredAffinityMatrix(self, filter_threshold, outpath):
-        '''Filter edges with weights below threshold'''
+    def getFilteredAffinityMatrix(self, filter_threshold, outpath, save = True):
+        '''Filter edges with weights below threshold. Save the filtered matrix unless save is False'''
+        if issparse(self.affinityMatrix):
+            filteredAffinityMatrix = self.affinityMatrix.multiply(self.affinityMatrix > filter_threshold).tocsr()
+            if save:
+                writeSparseMatrix(outpath + 'filteredAffinityMatrix', filteredAffinityMatrix, self.sample_fileList, self.matrix_dtype)
+            return filteredAffinityMatrix
         adjacencyMatrix = self.affinityMatrix > filter_threshold
         filteredAffinityMatrix = self.affinityMatrix * adjacencyMatrix
-        filteredAffinityDf = DataFrame(filteredAffinityMatrix, index = self.sample_fileList, columns = self.sample_fileList)
-        with open(outpath + 'filteredAffinityMatrix.csv', 'w') as j:
-            filteredAffinityDf.to_csv(j)
-        del filteredAffinityDf
+        if save:
+            writeMatrix(outpath + 'filteredAffinityMatrix', filteredAffinityMatrix, self.sample_fileList, self.matrix_dtype, self.write_csv)
         return filteredAffinityMatrix
 
+    def getFilteredRmsdMatrix(self):
+        '''Graph between conformers used for eccentricity and betweenness centroids'''
+        if issparse(self.rmsdMatrix):
+            filteredRmsdMatrix = self.rmsdMatrix.copy()
+            filteredRmsdMatrix.data = filteredRmsdMatrix.data * filteredRmsdMatrix.data < np.sqrt(-np.log(self.threshold))
+            filteredRmsdMatrix.eliminate_zeros()
+            return filteredRmsdMatrix
+        return self.rmsdMatrix * self.rmsdMatrix < np.sqrt(-np.log(self.threshold))
+
+    def getCommunities(self, filteredAffinityMatrix):
+        '''Cluster the filtered graph with the algorithm chosen by community_detection'''
+        if self.community_detection not in communityDetectionMethods:
+            raise ValueError('community_detection "%s" not recognized. Use one of %s' %(self.community_detection, ', '.join(communityDetectionMethods)))
+        method = communityDetectionMethods[self.community_detection]
+        if self.n_starts <= 1:
+            self.stability = None
+            return method(filteredAffinityMatrix, Q_threshold = 0.0, max_iter = 50, resolution = 1.0)
+        # consensus of runs visiting conformers in different orders, distributed over n_jobs processes
+        assignments = multiStartClustering(filteredAffinityMatrix, self.n_starts, method, self.n_jobs, self.seed, Q_threshold = 0.0, max_iter = 50, resolution = 1.0)
+        communityAssignment = consensusPartition(filteredAffinityMatrix, assignments, method, Q_threshold = 0.0, max_iter = 50, resolution = 1.0)
+        self.stability = clusterStability(communityAssignment, assignments)
+        return communityAssignment
+
     def getCentroids(self, communityAssignment, Epath='', E_label='energy', filteredAffinityMatrix=None):
         '''Return file names of conformers designated as centroids. If energy is provided, find lowest energy conformers in each cluster. Otherwise choose by maximum in-cluster weighted degree'''
+        communityIndex = self.getCommunityIndex(communityAssignment, self.sample_fileList)
+        self.centralityErrors = None
+        # centralities of clusters above centrality_cutoff members are approximated from centrality_pivots searches
+        pivots = None if self.centrality_cutoff is None else self.centrality_pivots
         if Epath == '':
             if self.centroid_selection == 'degree':
-                self.centroids = centroid_weighted_degree(self.sample_fileList, communityAssignment, filteredAffinityMatrix)
+                self.centroids = centroid_weighted_degree(self.sample_fileList, communityAssignment, filteredAffinityMatrix, communityIndex, n_jobs = self.n_jobs)
             elif self.centroid_selection == 'eccentricity':
-                self.centroids = centroid_eccentricity(self.sample_fileList, communityAssignment, self.rmsdMatrix * self.rmsdMatrix < np.sqrt(-np.log(self.threshold))) # add filtered rmsd matrix
+                self.centroids, self.centralityErrors = centroid_eccentricity(self.sample_fileList, communityAssignment, self.getFilteredRmsdMatrix(), communityIndex, pivots = pivots, cutoff = self.centrality_cutoff, return_error = True, n_jobs = self.n_jobs) # add filtered rmsd matrix
             elif self.centroid_selection == 'betweenness':
-                self.centroids = centroid_betweenness(self.sample_fileList, communityAssignment, self.rmsdMatrix * self.rmsdMatrix < np.sqrt(-np.log(self.threshold))) # add filtered rmsd matrix
+                seed = 0 if self.seed is None else self.seed
+                self.centroids, self.centralityErrors = centroid_betweenness(self.sample_fileList, communityAssignment, self.getFilteredRmsdMatrix(), communityIndex, seed = seed, pivots = pivots, cutoff = self.centrality_cutoff, return_error = True, n_jobs = self.n_jobs) # add filtered rmsd matrix
             else:
                 print('centroid criterion not recognized. Use keywords "degree", "eccentricity", or "betweenness" for centroid_selection or provide an energy output to base the selection')
         else:
             self.centroids = centroid_energy(self.sample_fileList, communityAssignment, Epath, E_label)
 
+    def getCommunityIndex(self, communityAssignment, fileList):
+        '''Index of the members of each community. Built once per community assignment and shared by centroid selection and reporting'''
+        if self.communityIndex is None or not self.communityIndex.describes(communityAssignment, fileList):
+            self.communityIndex = CommunityIndex(communityAssignment, fileList)
+        return self.communityIndex
+
     def report_save(self, inpath, outpath, communityAssignment):
         '''Report clustering results in save files.'''
         inpath, outpath = self.formatPaths(inpath, outpath)
         cluster_names = ['cluster' + str(x) for x in range(len(self.centroids))]
+        fileList = self.sample_fileList
         if self.subset > 0:
             sample_communityAssignment = list(communityAssignment)
-            communityAssignment = assign_remaining_files(self.master_fileList, self.sample_fileList, self.centroids, sample_communityAssignment, inpath)
+            communityAssignment = assign_remaining_files(self.master_fileList, self.sample_fileList, self.centroids, sample_communityAssignment, inpath, self.hetatm, self.n_jobs, distancePath = outpath + 'assignmentDistances.csv', cluster_names = cluster_names)
+            # the assignment now covers all files, in the order of master_fileList
+            fileList = self.master_fileList
+            communityIndex = self.getCommunityIndex(communityAssignment, fileList)
         else:
+            communityIndex = self.getCommunityIndex(communityAssignment, fileList)
             # Note: cluster statistics requires the RMSD matrix. If subset is used, then RMSD matrix is for the subset, not all files.
             # Cluster stats require the full RMSD matrix, so will be computed only for clustering without subsetting.
-            stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.sample_fileList, cluster_names)
+            stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.sample_fileList, cluster_names, communityIndex)
+            if self.stability is not None:
+                clusterStabilities, pooledStability = self.stability
+                stats['stability'] = [clusterStabilities[C] for C in communityIndex.communityOf(self.centroids)] + [pooledStability, np.nan]
+            if self.centralityErrors is not None and any(self.centralityErrors.values()):
+                # relative standard error of estimated betweenness, or absolute bound on the excess eccentricity (in edges of the filtered graph)
+                errorColumn = {'betweenness': 'betweenness_relative_se', 'eccentricity': 'eccentricity_error_bound'}[self.centroid_selection]
+                stats[errorColumn] = [self.centralityErrors[x] for x in self.centroids] + [np.nan, np.nan]
             with open(outpath + 'communityStats.csv', 'w') as h:
                 stats.to_csv(h)
             if not self.silence:
                 print('Cluster statistics: ')
                 print(stats)
 # bug found by elifzeng and corrected by KAT (2021-12-10). changed self.master_fileList to self.sample_fileList
-        cluster_summary(outpath, self.sample_fileList, communityAssignment, self.centroids, cluster_names)
+        cluster_summary(outpath, fileList, communityAssignment, self.centroids, cluster_names, communityIndex)
 
         if self.copy_conformers:
-            save_outputs(inpath, outpath, self.sample_fileList, communityAssignment, self.centroids, cluster_names)
+            exported = save_outputs(inpath, outpath, fileList, communityAssignment, self.centroids, cluster_names, self.export_mode, communityIndex = communityIndex)
+            if not self.silence:
+                print(exportReport(*exported))
 
         if not self.silence:
             print('Number of structures: ', len(self.master_fileList))
@@ -157,10 +235,30 @@ class AutoGraph:
         self.getAffinityMatrix(inpath, outpath)
         self.getThreshold()
         filtAff = self.getFilteredAffinityMatrix(self.threshold, outpath)
-        communityAssignment = Louvain(filtAff, Q_threshold = 0.0, max_iter = 50, resolution = 1.0)
+        communityAssignment = self.getCommunities(filtAff)
         self.getCentroids(communityAssignment, Epath, E_label, filtAff)
         self.report_save(inpath, outpath, communityAssignment)
 
+    def sweep(self, inpath, outpath, resolutions = (0.5, 1.0, 1.5, 2.0)):
+        '''Cluster the filtered graph at several resolutions, in parallel with n_jobs processes. Matrices of a previous run or sweep by this instance are reused, and none is saved again. The modularity and number of clusters per resolution are saved to resolutionSweep.csv\nresolutions: (sequence of float) resolutions of the modularity maximized by community_detection. Above 1 favors more, smaller clusters\noutput: (pandas.DataFrame) indexed by resolution, with the modularity (resolution 1), the modularity at the resolution, the number of clusters, and the community assignment corresponding to sample_fileList'''
+        inpath, outpath = self.formatPaths(inpath, outpath)
+        if not hasattr(self, 'affinityMatrix') or type(self.affinityMatrix) == type(None):
+            self.set_up(inpath, outpath)
+            self.getRmsdMatrix(inpath, outpath)
+            self.getAffinityMatrix(inpath, outpath, save = False)
+        self.getThreshold()
+        filtAff = self.getFilteredAffinityMatrix(self.threshold, outpath, save = False)
+        if self.community_detection not in communityDetectionMethods:
+            raise ValueError('community_detection "%s" not recognized. Use one of %s' %(self.community_detection, ', '.join(communityDetectionMethods)))
+        results = resolutionSweep(filtAff, list(resolutions), communityDetectionMethods[self.community_detection], self.n_jobs, Q_threshold = 0.0, max_iter = 50)
+        sweepDf = DataFrame({'modularity': [x[0] for x in results], 'resolution_modularity': [x[1] for x in results], 'num_clusters': [len(set(x[2])) for x in results], 'assignment': [x[2] for x in results]}, index = list(resolutions))
+        sweepDf.index.name = 'resolution'
+        with open(outpath + 'resolutionSweep.csv', 'w') as h:
+            sweepDf.drop(columns = 'assignment').to_csv(h)
+        if not self.silence:
+            print(sweepDf.drop(columns = 'assignment'))
+        return sweepDf
+
 # If not imported, but rather executed as the main source code, begin interactive program.
 
 if __name__ == '__main__':
@@ -207,7 +305,7 @@ if __name__ == '__main__':
             print('Response not recognized. Conformer files will be copied into respective subdirectories.')
             copy_conformers = True
     ag = AutoGraph(randomize, subset, copy_conformers)
-    print('Enter input path to the directory containing XYZ or PDB files to cluster. (Where your files are located on your computer.)')
+    print('Enter input path to the directory containing XYZ or PDB files to cluster, or to a multi-frame XYZ, PDB, or SDF file. (Where your files are located on your computer.)')
     inpath = input()
     print('Enter output path to the directory to save results.')
     outpath = input()
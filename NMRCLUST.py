@@ -17,27 +17,38 @@ from pandas import DataFrame, read_csv
 import os
 if __name__ == '__main__':
     from lib.functions import *
-    from lib.rmsd import rmsd, rmsdMatrix
+    from lib.rmsd import rmsd, cachedRmsdMatrix
+    from lib.conformerCache import resolveCacheDir
+    from lib.export import save_outputs, exportReport
+    from lib.communityIndex import CommunityIndex
     from lib.NMRCLUST import NMRCLUST_
     from lib.select_centroids import centroid_medoid
 else:
     from .lib.functions import *
-    from .lib.rmsd import rmsd, rmsdMatrix
+    from .lib.rmsd import rmsd, cachedRmsdMatrix
+    from .lib.conformerCache import resolveCacheDir
+    from .lib.export import save_outputs, exportReport
+    from .lib.communityIndex import CommunityIndex
     from .lib.NMRCLUST import NMRCLUST_
     from .lib.select_centroids import centroid_medoid
 
 class NMRCLUST:
     '''An automated approach for clustering an ensemble of NMR- derived protein structures into conformationally related subfamilies - DOI: 10.1093/protein/9.11.1063'''
 
-    def __init__(self, copy_conformers = True, silence = False, hetatm = True):
-        '''copy_conformers: (Boolean) make subdirectories for clusters populated by their conformers. Turn to False if copying all structures compromises device memory\nsilence: (Boolean) if True, forgo all print statements. Consider if calling AutoGraph in a loop to avoid crowding the screen\nhetatm: (Boolean) if the input files are PDB, specify whether or not to read the coordinates of HETATM'''
+    def __init__(self, copy_conformers = True, silence = False, hetatm = True, n_jobs = 1, matrix_dtype = 'float64', write_csv = False, cache_dir = None, export_mode = 'copy'):
+        '''copy_conformers: (Boolean) make subdirectories for clusters populated by their conformers. Turn to False if copying all structures compromises device memory\nsilence: (Boolean) if True, forgo all print statements. Consider if calling AutoGraph in a loop to avoid crowding the screen\nhetatm: (Boolean) if the input files are PDB, specify whether or not to read the coordinates of HETATM\nn_jobs: (int) number of processes for computing the RMSD matrix and selecting medoids. -1 uses all cores\nmatrix_dtype: (string) precision of the saved RMSD matrix, "float64" or "float32"\nwrite_csv: (Boolean) also export the RMSD matrix as a csv file\ncache_dir: (string) directory of the parsed coordinate and RMSD cache shared by all clustering methods. None (default) disables the cache, '' uses $XDG_CACHE_HOME/autograph (~/.cache/autograph)\nexport_mode: (string) how conformers are saved in the cluster directories when copy_conformers is True. "copy", "hardlink", "symlink", or "tar" / "zip" for one archive per cluster'''
         self.copy_conformers = copy_conformers
         self.silence = silence
         self.hetatm = hetatm
+        self.n_jobs = n_jobs
+        self.matrix_dtype = matrix_dtype
+        self.write_csv = write_csv
+        self.cache_dir = cache_dir
+        self.export_mode = export_mode
 
     def formatPaths(self, inpath, outpath):
-        '''Append "/" to end of path if not present'''
-        if inpath[-1] != '/':
+        '''Append "/" to end of path if not present. A multi-frame input file is left as is'''
+        if inpath[-1] != '/' and not isEnsemble(inpath):
             inpath = inpath + '/'
         if outpath[-1] != '/':
             outpath = outpath + '/'
@@ -46,41 +57,43 @@ class NMRCLUST:
     def set_up(self, inpath, outpath):
         '''Set up the output directory and read input data'''
         inpath, outpath = self.formatPaths(inpath, outpath)
-        self.fileList = [x for x in os.listdir(inpath) if x[-3:] in ['xyz', 'pdb', 'mol']]
+        self.fileList = listConformers(inpath)
         self.numFiles = len(self.fileList)
         if not os.path.exists(outpath):
-            os.system('mkdir ' + outpath)
+            os.makedirs(outpath)
         self.rmsdMatrix = None
-        if 'rmsdMatrix.csv' in os.listdir(outpath):
-            self.rmsdMatrix = read_csv(outpath + 'rmsdMatrix.csv', index_col = 0)
-            self.rmsdMatrix = self.rmsdMatrix.reindex(index = self.fileList, columns = self.fileList)
-            self.rmsdMatrix = self.rmsdMatrix.to_numpy()
+        self.communityIndex = None
 
     def getRmsdMatrix(self, inpath, outpath):
-        '''If RMSD matrix has not been read, compute and save it'''
+        '''Read the RMSD matrix cached in outpath, computing only the pairs involving new or modified files, and save it'''
         inpath, outpath = self.formatPaths(inpath, outpath)
         if type(self.rmsdMatrix) == type(None):
-            self.rmsdMatrix = rmsdMatrix(self.fileList, inpath, self.hetatm)
-            rmsdDf = DataFrame(self.rmsdMatrix, index = self.fileList, columns = self.fileList)
-            with open(outpath + 'rmsdMatrix.csv', 'w') as g:
-                rmsdDf.to_csv(g)
-            del rmsdDf
+            self.rmsdMatrix = cachedRmsdMatrix(self.fileList, inpath, outpath + 'rmsdMatrix', self.hetatm, self.n_jobs, self.matrix_dtype, self.write_csv, resolveCacheDir(self.cache_dir))
+
+    def getCommunityIndex(self, communityAssignment, fileList):
+        '''Index of the members of each community. Built once per community assignment and shared by centroid selection and reporting'''
+        if self.communityIndex is None or not self.communityIndex.describes(communityAssignment, fileList):
+            self.communityIndex = CommunityIndex(communityAssignment, fileList)
+        return self.communityIndex
 
     def report_save(self, inpath, outpath, communityAssignment):
         '''Report clustering results and save outputs'''
         inpath, outpath = self.formatPaths(inpath, outpath)
         cluster_names = ['cluster' + str(x) for x in range(len(self.centroids))]
-        stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.fileList, cluster_names)
+        communityIndex = self.getCommunityIndex(communityAssignment, self.fileList)
+        stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.fileList, cluster_names, communityIndex)
         with open(outpath + 'communityStats.csv', 'w') as h:
             stats.to_csv(h)
         if not self.silence:
             print('Cluster statistics: ')
             print(stats)
 
-        cluster_summary(outpath, self.fileList, communityAssignment, self.centroids, cluster_names)
+        cluster_summary(outpath, self.fileList, communityAssignment, self.centroids, cluster_names, communityIndex)
 
         if self.copy_conformers:
-            save_outputs(inpath, outpath, self.fileList, communityAssignment, self.centroids, cluster_names)
+            exported = save_outputs(inpath, outpath, self.fileList, communityAssignment, self.centroids, cluster_names, self.export_mode, communityIndex = communityIndex)
+            if not self.silence:
+                print(exportReport(*exported))
 
         if not self.silence:
             print('Number of structures: ', self.numFiles)
@@ -93,7 +106,7 @@ class NMRCLUST:
         self.set_up(inpath, outpath)
         self.getRmsdMatrix(inpath, outpath)
         communityAssignment = NMRCLUST_(self.rmsdMatrix)
-        self.centroids = centroid_medoid(self.fileList, communityAssignment, self.rmsdMatrix)
+        self.centroids = centroid_medoid(self.fileList, communityAssignment, self.rmsdMatrix, self.getCommunityIndex(communityAssignment, self.fileList), self.n_jobs)
         self.report_save(inpath, outpath, communityAssignment)
 
 # Interactive program to perform NMRCLUST on files of conformations without drafting a script.
@@ -115,7 +128,7 @@ if __name__ == '__main__':
         print('Response not recognized. Conformer files will be copied into respective subdirectories.')
         copy_conformers = True
     nmr = NMRCLUST(copy_conformers)
-    print('Enter input path to the directory containing XYZ/PDB/MOL files to cluster. (Where your files are located on your computer.)')
+    print('Enter input path to the directory containing XYZ/PDB/MOL files to cluster, or to a multi-frame XYZ/PDB/SDF file. (Where your files are located on your computer.)')
     inpath = input()
     print('Enter output path to the directory to save results.')
     outpath = input()
@@ -17,25 +17,37 @@ from pandas import DataFrame, read_csv
 import os
 if __name__ == '__main__':
     from lib.functions import *
-    from lib.rmsd import rmsdMatrix
+    from lib.rmsd import cachedRmsdMatrix
+    from lib.conformerCache import resolveCacheDir
+    from lib.export import save_outputs, exportReport
+    from lib.communityIndex import CommunityIndex
     from lib.RCKmeans import RCKmeans_
 else:
     from .lib.functions import *
-    from .lib.rmsd import rmsdMatrix
+    from .lib.rmsd import cachedRmsdMatrix
+    from .lib.conformerCache import resolveCacheDir
+    from .lib.export import save_outputs, exportReport
+    from .lib.communityIndex import CommunityIndex
     from .lib.RCKmeans import RCKmeans_
 
 class RCKmeans:
     '''The comparison of automated clustering algorithms for resampling representative conformer ensembles with RMSD matrix. DOI: 10.1186/s13321-017-0208-0'''
 
-    def __init__(self, copy_conformers = True, silence = False, hetatm = True):
-        '''copy_conformers: (Boolean) make subdirectories for clusters populated by their conformers. Turn to False if copying all structures compromises device memory\nsilence: (Boolean) if True, forgo all print statements. Consider if calling AutoGraph in a loop to avoid crowding the screen. \nhetatm: (Boolean) if the input files are PDB, specify whether or not to read the coordinates of HETATM'''
+    def __init__(self, copy_conformers = True, silence = False, hetatm = True, n_jobs = 1, matrix_dtype = 'float64', write_csv = False, cache_dir = None, export_mode = 'copy', seed = None):
+        '''copy_conformers: (Boolean) make subdirectories for clusters populated by their conformers. Turn to False if copying all structures compromises device memory\nsilence: (Boolean) if True, forgo all print statements. Consider if calling AutoGraph in a loop to avoid crowding the screen. \nhetatm: (Boolean) if the input files are PDB, specify whether or not to read the coordinates of HETATM\nn_jobs: (int) number of processes for computing the RMSD matrix and running the k-medoid restarts. -1 uses all cores\nmatrix_dtype: (string) precision of the saved RMSD matrix, "float64" or "float32"\nwrite_csv: (Boolean) also export the RMSD matrix as a csv file\ncache_dir: (string) directory of the parsed coordinate and RMSD cache shared by all clustering methods. None (default) disables the cache, '' uses $XDG_CACHE_HOME/autograph (~/.cache/autograph)\nexport_mode: (string) how conformers are saved in the cluster directories when copy_conformers is True. "copy", "hardlink", "symlink", or "tar" / "zip" for one archive per cluster\nseed: (int) seed of the random initial medoids of the k-medoid restarts'''
         self.copy_conformers = copy_conformers
         self.silence = silence
         self.hetatm = hetatm
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.matrix_dtype = matrix_dtype
+        self.write_csv = write_csv
+        self.cache_dir = cache_dir
+        self.export_mode = export_mode
 
     def formatPaths(self, inpath, outpath):
-        '''Append "/" to end of path if absent'''
-        if inpath[-1] != '/':
+        '''Append "/" to end of path if absent. A multi-frame input file is left as is'''
+        if inpath[-1] != '/' and not isEnsemble(inpath):
             inpath = inpath + '/'
         if outpath[-1] != '/':
             outpath = outpath + '/'
@@ -44,41 +56,43 @@ class RCKmeans:
     def set_up(self, inpath, outpath):
         '''Set up the output directory and read input data'''
         inpath, outpath = self.formatPaths(inpath, outpath)
-        self.fileList = [x for x in os.listdir(inpath) if x[-3:] in ['xyz', 'pdb', 'mol']]
+        self.fileList = listConformers(inpath)
         self.numFiles = len(self.fileList)
         if not os.path.exists(outpath):
-            os.system('mkdir ' + outpath)
+            os.makedirs(outpath)
         self.rmsdMatrix = None
-        if 'rmsdMatrix.csv' in os.listdir(outpath):
-            self.rmsdMatrix = read_csv(outpath + 'rmsdMatrix.csv', index_col = 0)
-            self.rmsdMatrix = self.rmsdMatrix.reindex(index = self.fileList, columns = self.fileList)
-            self.rmsdMatrix = self.rmsdMatrix.to_numpy()
+        self.communityIndex = None
 
     def getRmsdMatrix(self, inpath, outpath):
-        '''If RMSD matrix has not been read, compute and save it'''
+        '''Read the RMSD matrix cached in outpath, computing only the pairs involving new or modified files, and save it'''
         inpath, outpath = self.formatPaths(inpath, outpath)
         if type(self.rmsdMatrix) == type(None):
-            self.rmsdMatrix = rmsdMatrix(self.fileList, inpath, self.hetatm)
-            rmsdDf = DataFrame(self.rmsdMatrix, index = self.fileList, columns = self.fileList)
-            with open(outpath + 'rmsdMatrix.csv', 'w') as g:
-                rmsdDf.to_csv(g)
-            del rmsdDf
+            self.rmsdMatrix = cachedRmsdMatrix(self.fileList, inpath, outpath + 'rmsdMatrix', self.hetatm, self.n_jobs, self.matrix_dtype, self.write_csv, resolveCacheDir(self.cache_dir))
+
+    def getCommunityIndex(self, communityAssignment, fileList):
+        '''Index of the members of each community. Built once per community assignment and shared by centroid selection and reporting'''
+        if self.communityIndex is None or not self.communityIndex.describes(communityAssignment, fileList):
+            self.communityIndex = CommunityIndex(communityAssignment, fileList)
+        return self.communityIndex
 
     def report_save(self, inpath, outpath, communityAssignment):
         '''Report clustering results and save files'''
         inpath, outpath = self.formatPaths(inpath, outpath)
         cluster_names = ['cluster' + str(x) for x in range(len(self.centroids))]
-        stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.fileList, cluster_names)
+        communityIndex = self.getCommunityIndex(communityAssignment, self.fileList)
+        stats = clusterStats(self.rmsdMatrix, communityAssignment, self.centroids, self.fileList, cluster_names, communityIndex)
         with open(outpath + 'communityStats.csv', 'w') as h:
             stats.to_csv(h)
         if not self.silence:
             print('Cluster statistics: ')
             print(stats)
 
-        cluster_summary(outpath, self.fileList, communityAssignment, self.centroids, cluster_names)
+        cluster_summary(outpath, self.fileList, communityAssignment, self.centroids, cluster_names, communityIndex)
 
         if self.copy_conformers:
-            save_outputs(inpath, outpath, self.fileList, communityAssignment, self.centroids, cluster_names)
+            exported = save_outputs(inpath, outpath, self.fileList, communityAssignment, self.centroids, cluster_names, self.export_mode, communityIndex = communityIndex)
+            if not self.silence:
+                print(exportReport(*exported))
 
         if not self.silence:
             print('Number of structures: ', len(self.fileList))
@@ -90,7 +104,7 @@ class RCKmeans:
         inpath, outpath = self.formatPaths(inpath, outpath)
         self.set_up(inpath, outpath)
         self.getRmsdMatrix(inpath, outpath)
-        communityAssignment, centroid_indices = RCKmeans_(self.rmsdMatrix)
+        communityAssignment, centroid_indices = RCKmeans_(self.rmsdMatrix, n_jobs = self.n_jobs, seed = self.seed)
         self.centroids = [self.fileList[x] for x in centroid_indices]
         self.report_save(inpath, outpath, communityAssignment)
 
@@ -114,7 +128,7 @@ if __name__ == '__main__':
         print('Response not recognized. Conformer files will be copied into respective subdirectories.')
         copy_conformers = True
     rck = RCKmeans(copy_conformers)
-    print('Enter input path to the directory containing XYZ/PDB/MOL files to cluster. (Where your files are located on your computer.)')
+    print('Enter input path to the directory containing XYZ/PDB/MOL files to cluster, or to a multi-frame XYZ/PDB/SDF file. (Where your files are located on your computer.)')
     inpath = input()
     print('Enter output path to the directory to save results.')
     outpath = input()
@@ -0,0 +1,173 @@
+# 2021-07-19
+
+# Kiyoto Aramis Tanemura
+
+# Leiden algorithm (Traag, V. A.; Waltman, L.; van Eck, N. J. Sci. Rep. 2019, 9, 5233. DOI: 10.1038/s41598-019-41695-z)
+# Same interface as Louvain in LouvainClustering.py. Each level has three steps:
+# 1. fast local moves: nodes are visited from a queue, and only the neighbors of a node that changed community are queued again
+# 2. refinement: each community is split into subcommunities grown by merging well connected nodes within the community,
+#    so that every community of the result is connected
+# 3. aggregation of the refined partition, starting the next level from the unrefined communities
+# The refinement is greedy (each node joins the subcommunity of largest gain) rather than randomized, so the result is
+# deterministic for a given node order, as with Louvain.
+
+import numpy as np
+from collections import deque
+from scipy.sparse import csr_matrix
+from .LouvainClustering import getDegrees, getModularitySparse, LouvainPhase2Sparse
+
+def fastLocalMoves(graph, communityAssignment, resolution = 1.0):
+    # Move nodes to the community of largest modularity gain until no move improves modularity
+    # inputs
+    # graph: (scipy.sparse CSR matrix) symmetric graph, self loops on the diagonal
+    # communityAssignment: (list of int) initial community of each node, labels in 0..n-1
+    # output: updated community assignment (list of int, labels in 0..n-1) and the number of node visits
+    num_nodes = graph.shape[0]
+    degrees = getDegrees(graph)
+    two_m = np.sum(degrees)
+    labels = np.asarray(communityAssignment)
+    sigma_tot = np.bincount(labels, weights = degrees, minlength = num_nodes).tolist()
+    used = np.bincount(labels, minlength = num_nodes)
+    # communities without members, to move a node out on its own
+    empty = np.flatnonzero(used == 0).tolist()[::-1]
+    size = used.tolist()
+    indptr, indices, weights = graph.indptr.tolist(), graph.indices.tolist(), graph.data.tolist()
+    degrees, labels = degrees.tolist(), labels.tolist()
+
+    queue = deque(range(num_nodes))
+    queued = [True] * num_nodes
+    visits = 0
+    while queue:
+        i = queue.popleft()
+        queued[i] = False
+        visits += 1
+        neighbors = indices[indptr[i]:indptr[i + 1]]
+        ki_in = {}
+        for j, w in zip(neighbors, weights[indptr[i]:indptr[i + 1]]):
+            if j != i:
+                C = labels[j]
+                ki_in[C] = ki_in.get(C, 0) + w
+        own = labels[i]
+        ki = degrees[i]
+        scale = resolution * ki / two_m
+        # gains in units of m times the change of modularity, node i removed from its community
+        stay = ki_in.get(own, 0) - scale * (sigma_tot[own] - ki)
+        maxGain = 0 if size[own] > 1 else stay
+        communityToJoin = -1 if size[own] > 1 else own
+        for C, w in ki_in.items():
+            if C == own:
+                continue
+            gain = w - scale * sigma_tot[C]
+            if gain > maxGain or (gain == maxGain and 0 <= C < communityToJoin):
+                maxGain = gain
+                communityToJoin = C
+        if maxGain <= stay:
+            continue
+        if communityToJoin < 0:
+            communityToJoin = empty.pop()
+        sigma_tot[own] -= ki
+        size[own] -= 1
+        if size[own] == 0:
+            empty.append(own)
+        sigma_tot[communityToJoin] += ki
+        size[communityToJoin] += 1
+        labels[i] = communityToJoin
+        for j in neighbors:
+            if not queued[j] and labels[j] != communityToJoin:
+                queue.append(j)
+                queued[j] = True
+    return labels, visits
+
+def refinePartition(graph, communityAssignment, resolution = 1.0):
+    # Split each community into subcommunities. Starting from singletons, each well connected node that is still alone
+    # joins the well connected subcommunity of the same community with the largest positive modularity gain
+    # output: (list of int) refined assignment. Labels are node indices
+    num_nodes = graph.shape[0]
+    degrees = getDegrees(graph)
+    two_m = np.sum(degrees)
+    labels = np.asarray(communityAssignment)
+    K_S = np.bincount(labels, weights = degrees, minlength = num_nodes)
+    coo = graph.tocoo()
+    sameCommunity = (labels[coo.row] == labels[coo.col]) & (coo.row != coo.col)
+    # weight from each subcommunity to the rest of its community. Initially subcommunities are single nodes
+    external = np.bincount(coo.row[sameCommunity], weights = coo.data[sameCommunity], minlength = num_nodes).tolist()
+    del coo, sameCommunity
+    indptr, indices, weights = graph.indptr.tolist(), graph.indices.tolist(), graph.data.tolist()
+    K_S, degrees, labels = K_S.tolist(), degrees.tolist(), labels.tolist()
+    refined = list(range(num_nodes))
+    K_C = list(degrees)
+    size = [1] * num_nodes
+
+    for i in range(num_nodes):
+        if size[refined[i]] > 1:
+            continue
+        S = labels[i]
+        ki = degrees[i]
+        if external[i] < resolution * ki * (K_S[S] - ki) / two_m:
+            continue
+        ki_in = {}
+        for j, w in zip(indices[indptr[i]:indptr[i + 1]], weights[indptr[i]:indptr[i + 1]]):
+            if j != i and labels[j] == S:
+                C = refined[j]
+                ki_in[C] = ki_in.get(C, 0) + w
+        maxGain = 0
+        communityToJoin = -1
+        for C, w in ki_in.items():
+            if external[C] < resolution * K_C[C] * (K_S[S] - K_C[C]) / two_m:
+                continue
+            gain = w - resolution * ki * K_C[C] / two_m
+            if gain > maxGain or (gain == maxGain and C < communityToJoin):
+                maxGain = gain
+                communityToJoin = C
+        if communityToJoin < 0:
+            continue
+        # edges between node i and the subcommunity become internal
+        external[communityToJoin] += external[i] - 2 * ki_in[communityToJoin]
+        K_C[communityToJoin] += ki
+        size[communityToJoin] += 1
+        size[i] = 0
+        refined[i] = communityToJoin
+    return refined
+
+def Leiden(affinityMatrix, Q_threshold = 0.001, max_iter = 50, resolution = 1.0):
+    # Cluster a graph with the Leiden algorithm. Same inputs and output as Louvain
+    # affinityMatrix: (numpy array or scipy.sparse matrix) symmetric affinity matrix. Clear diagonals and filter edges with weights below threshold
+    # Q_threshold: minimum gain of modularity over a level to continue, once the aggregated graph has one node per community
+    # max_iter: maximum number of levels
+    # output: (list of int) community of each node. Each community is labeled by its lowest node index
+    graph = csr_matrix(affinityMatrix, dtype = float)
+    num_nodes = graph.shape[0]
+    # node of the aggregated graph holding each original node
+    node = np.arange(num_nodes)
+    comm = list(range(num_nodes))
+    aggregatedOnCommunities = False
+    iterations = 0
+    while iterations < max_iter:
+        modularity_past = getModularitySparse(graph, comm, resolution)
+        comm, _ = fastLocalMoves(graph, comm, resolution)
+        numCommunities = len(set(comm))
+        if numCommunities == graph.shape[0]:
+            break
+        modularity_curr = getModularitySparse(graph, comm, resolution)
+        if aggregatedOnCommunities and modularity_curr - modularity_past <= Q_threshold:
+            break
+        refined = refinePartition(graph, comm, resolution)
+        numRefined = len(set(refined))
+        if numRefined == graph.shape[0]:
+            # no node was merged by the refinement. Aggregate the communities themselves
+            refined = comm
+            numRefined = numCommunities
+        aggregatedOnCommunities = numRefined == numCommunities
+        graph, supernodes = LouvainPhase2Sparse(graph, refined)
+        aggregateIndex = np.unique(refined, return_inverse = True)[1].ravel()
+        # the next level starts from the unrefined communities, one label per aggregated node
+        parent = np.empty(graph.shape[0], dtype = int)
+        parent[aggregateIndex] = comm
+        comm = np.unique(parent, return_inverse = True)[1].ravel().tolist()
+        node = aggregateIndex[node]
+        iterations += 1
+
+    flat = np.unique(np.asarray(comm)[node], return_inverse = True)[1].ravel()
+    first = np.full(flat.max() + 1, num_nodes)
+    np.minimum.at(first, flat, np.arange(num_nodes))
+    return first[flat].tolist()
@@ -5,90 +5,149 @@
 # Code for Louvain algorithm was getting lengthy. I dedicate its own module
 
 import numpy as np
+from scipy.sparse import issparse, csr_matrix
 
 def getModularity(affinityMatrix, communityAssignments, resolution = 1.0):
-    # Provided an affinity matrix (np.array) and nodes specifying their assigned communities (list),
+    # Provided an affinity matrix (np.array or scipy.sparse matrix) and nodes specifying their assigned communities (list),
     # return the modularity of the whole graph
-    arrayDim = affinityMatrix.shape[0]
-    communities = list(set(communityAssignments))
-    Q = 0
-    affinityMatrix[range(arrayDim), range(arrayDim)] += affinityMatrix[range(arrayDim), range(arrayDim)]
-    two_m = np.sum(affinityMatrix)
-    for C in communities:
-        communityIndices = [i for i in range(len(communityAssignments)) if communityAssignments[i] == C]
-        sigma_in = np.sum(affinityMatrix[communityIndices, :][:, communityIndices])
-        sigma_tot = np.sum(affinityMatrix[communityIndices, :])
-        Q += sigma_in / two_m - resolution * (sigma_tot / two_m) ** 2
-    return Q
+    if not issparse(affinityMatrix):
+        affinityMatrix = csr_matrix(affinityMatrix, dtype = float)
+    return getModularitySparse(affinityMatrix, communityAssignments, resolution)
 
 def LouvainPhase1(affinityMatrix, communityAssignment, Q_threshold, max_iter, resolution):
-    # inputs: affinityMatrix as numpy array. Clear diagonals prior to entering and filter edges with weights below threshold
+    # inputs: affinityMatrix as numpy array or scipy.sparse matrix. Clear diagonals prior to entering and filter edges with weights below threshold
     # communityAssignments: list of length of nodes. Values are community IDs
     # Q_threshold: minimum global modularity to terminate phase 1
     # max_iter: number of iteration to force termination of phase 1
     # output: updated community Assignment list
+    if not issparse(affinityMatrix):
+        affinityMatrix = csr_matrix(affinityMatrix, dtype = float)
+    return LouvainPhase1Sparse(affinityMatrix, communityAssignment, Q_threshold, max_iter, resolution)
 
-    num_nodes = affinityMatrix.shape[0]
-
-    affinityMatrix[range(num_nodes), range(num_nodes)] += affinityMatrix[range(num_nodes), range(num_nodes)]
-
-    two_m = np.sum(affinityMatrix)
-
-    modularity_current = getModularity(affinityMatrix, communityAssignment, resolution)
+def LouvainPhase2(affinityMatrix, communityAssignment):
+    # Merge each communities into supernodes
+    # input: affinityMatrix or condensed graph
+    # output: condensed graph (same type as affinityMatrix) and list of communities corresponding to the axis of graph
+    if issparse(affinityMatrix):
+        return LouvainPhase2Sparse(affinityMatrix, communityAssignment)
+    phase2graph, communities = LouvainPhase2Sparse(csr_matrix(affinityMatrix, dtype = float), communityAssignment)
+    return phase2graph.toarray(), communities
+
+# Phases on a scipy.sparse CSR graph, so that memory scales with the number of edges rather than n^2. Dense matrices are converted.
+# The diagonal of an aggregated graph holds the weight of edges within the supernode. Self loops count twice toward the degree.
+
+def getDegrees(graph):
+    # weighted degree of each node of a CSR graph, self loops counted twice
+    return np.asarray(graph.sum(axis = 1)).ravel() + graph.diagonal()
+
+def getModularitySparse(graph, communityAssignments, resolution = 1.0):
+    # Sparse counterpart of getModularity. graph is a symmetric CSR matrix
+    labels = np.unique(communityAssignments, return_inverse = True)[1].ravel()
+    degrees = getDegrees(graph)
+    two_m = np.sum(degrees)
+    coo = graph.tocoo()
+    internal = labels[coo.row] == labels[coo.col]
+    sigma_in = np.bincount(labels[coo.row[internal]], weights = coo.data[internal], minlength = labels.max() + 1).astype(float)
+    sigma_in += np.bincount(labels, weights = graph.diagonal(), minlength = labels.max() + 1)
+    sigma_tot = np.bincount(labels, weights = degrees, minlength = labels.max() + 1)
+    return np.sum(sigma_in / two_m - resolution * (sigma_tot / two_m) ** 2)
+
+def LouvainPhase1Sparse(graph, communityAssignment, Q_threshold, max_iter, resolution):
+    # Move each node, in order, to the neighboring community of largest gain. Ties go to the community of lowest ID.
+    # The total degree of each community (sigma_tot) and the modularity are updated with each move. The weights from
+    # a node to its neighboring communities are summed over its row of the CSR graph, so that a sweep costs O(edges)
+    num_nodes = graph.shape[0]
+    degrees = getDegrees(graph)
+    two_m = np.sum(degrees)
+    # communities are only joined, never created, so they are renumbered 0..k-1 in ascending order of their ID
+    communities, labels = np.unique(communityAssignment, return_inverse = True)
+    labels = labels.ravel()
+    sigma_tot = np.bincount(labels, weights = degrees, minlength = len(communities))
+    coo = graph.tocoo()
+    internal = (labels[coo.row] == labels[coo.col]) & (coo.row != coo.col)
+    # modularity = sum_in / two_m - resolution * sum_tot2 / two_m ** 2. Self loops stay with their node, so they never change sum_in
+    sum_in = np.sum(coo.data[internal]) + 2 * np.sum(graph.diagonal())
+    sum_tot2 = np.sum(sigma_tot ** 2)
+    del coo, internal
+
+    indptr, indices, weights = graph.indptr.tolist(), graph.indices.tolist(), graph.data.tolist()
+    degrees, labels, sigma_tot = degrees.tolist(), labels.tolist(), sigma_tot.tolist()
+    half_two_m_squared = two_m ** 2 / 2
+
+    modularity_current = sum_in / two_m - resolution * sum_tot2 / two_m ** 2
     changeModularity = 1
-
-    adjacencyMatrix = affinityMatrix > 0
     iterations = 0
 
     while changeModularity > Q_threshold and iterations < max_iter:
         modularity_prev = modularity_current
-        for i in range(num_nodes): # for each node
-            neighborIndices = [j for j in range(num_nodes) if adjacencyMatrix[i,j] == 1]
-            communities = set([communityAssignment[k] for k in neighborIndices])
-            communities.discard(communityAssignment[i])
-            communities = list(communities)
-            modularityList = []
-            # ki: sum of edges incident to node i 
-            ki = np.sum(affinityMatrix[i, :])
-            for C in communities:
-                C_members = [x for x in range(num_nodes) if communityAssignment[x] == C]
-                # Sum weights of all edges incident to nodes in C
-                sigma_tot = np.sum(affinityMatrix[C_members, :])
-                # ki_in: sum of weight of edges incident to node i in C
-                ki_in = np.sum(affinityMatrix[i, :][C_members])
-                deltaQ = ki_in/two_m - resolution * sigma_tot * ki / (two_m ** 2 / 2) # simplified formula. Derivation from (https://hal.archives-ouvertes.fr/hal-01231784/document)
-                modularityList.append(deltaQ)
-            modularityList.append(0) # append zero to avoid error by empty list
-            maxQgain = np.max(modularityList)
-            if maxQgain > 0:
-                communityToJoin = communities[modularityList.index(maxQgain)]
-                communityAssignment[i] = communityToJoin
-        modularity_current = getModularity(affinityMatrix, communityAssignment, resolution)
+        moved = False
+        for i in range(num_nodes):
+            # ki_in: sum of weight of edges incident to node i in each neighboring community
+            ki_in = {}
+            for j, w in zip(indices[indptr[i]:indptr[i + 1]], weights[indptr[i]:indptr[i + 1]]):
+                if j != i:
+                    C = labels[j]
+                    ki_in[C] = ki_in.get(C, 0) + w
+            own = labels[i]
+            ki_own = ki_in.pop(own, 0)
+            ki = degrees[i]
+            maxQgain = 0
+            communityToJoin = -1
+            for C, w in ki_in.items():
+                deltaQ = w/two_m - resolution * sigma_tot[C] * ki / half_two_m_squared # simplified formula. Derivation from (https://hal.archives-ouvertes.fr/hal-01231784/document)
+                if deltaQ > maxQgain or (deltaQ == maxQgain and C < communityToJoin):
+                    maxQgain = deltaQ
+                    communityToJoin = C
+            if communityToJoin >= 0:
+                sum_in += 2 * (ki_in[communityToJoin] - ki_own)
+                sum_tot2 += 2 * ki * (sigma_tot[communityToJoin] - sigma_tot[own] + ki)
+                sigma_tot[own] -= ki
+                sigma_tot[communityToJoin] += ki
+                labels[i] = communityToJoin
+                moved = True
+        if moved:
+            modularity_current = sum_in / two_m - resolution * sum_tot2 / two_m ** 2
         changeModularity = modularity_current - modularity_prev
         iterations += 1
 
-    return communityAssignment
-
-def LouvainPhase2(affinityMatrix, communityAssignment):
-    # Merge each communities into supernodes
-    # input: affinityMatrix or condensed graph
-    # output: condensed graph and list of communities corresponding to the axis of graph
-    num_nodes = affinityMatrix.shape[0]
-    communities = list(set(communityAssignment))
-    num_communities = len(communities)
-    phase2graph = np.zeros([num_communities, num_communities])
-    for i in range(num_communities):
-        i_members = [x for x in range(num_nodes) if communityAssignment[x] == communities[i]]
-        for j in range(num_communities):
-            j_members = [x for x in range(num_nodes) if communityAssignment[x] == communities[j]]
-            phase2graph[i, j] = np.sum(affinityMatrix[i_members, :][:, j_members]) * (1/2) ** (i == j)
-            # if same communities, edges are double counted. If i == j, divide by two
-
-    return phase2graph, communities
+    return communities[labels].tolist()
+
+def LouvainPhase2Sparse(graph, communityAssignment):
+    # Merge each community into a supernode. The aggregated graph is computed in O(edges)
+    communities, labels = np.unique(communityAssignment, return_inverse = True)
+    labels = labels.ravel()
+    num_nodes = graph.shape[0]
+    membership = csr_matrix((np.ones(num_nodes), (np.arange(num_nodes), labels)), shape = (num_nodes, len(communities)))
+    phase2graph = (membership.T @ graph @ membership).tocsr()
+    # edges within a community were summed in both directions, self loops only once
+    selfLoops = np.bincount(labels, weights = graph.diagonal(), minlength = len(communities))
+    phase2graph.setdiag((phase2graph.diagonal() + selfLoops) / 2)
+    return phase2graph, communities.tolist()
+
+def relabelCommunities(communityAssignment, changes):
+    # Apply the community changes of a higher level, in order, to the assignment of the level below: the members of community
+    # old are moved to community new for each (old, new) in changes. A community may be moved again by a later change.
+    # Members are tracked by community rather than by node, so that the cost is O(n + k log k)
+    holder = {C: [C] for C in set(communityAssignment)}
+    for old, new in changes:
+        if old not in holder:
+            continue
+        moving = holder.pop(old)
+        if new in holder:
+            staying = holder[new]
+            if len(staying) < len(moving):
+                staying, moving = moving, staying
+            staying.extend(moving)
+            holder[new] = staying
+        else:
+            holder[new] = moving
+    final = {C: new for new, group in holder.items() for C in group}
+    return [final[C] for C in communityAssignment]
 
 def Louvain(affinityMatrix, Q_threshold = 0.001, max_iter = 50, resolution = 1.0):
     # perform the two phases of Louvain community iteratively
-    graph = affinityMatrix
+    # affinityMatrix may be a numpy array or a scipy.sparse matrix. Either is clustered as a CSR graph
+    graph = csr_matrix(affinityMatrix, dtype = float)
     comm = list(range(affinityMatrix.shape[0]))
     # communityAssignmentRecord and commRefList are lists of lists, with same lengths.
     # communityAssignmentRecord stores assingment after phase 1
@@ -98,26 +157,17 @@ def Louvain(affinityMatrix, Q_threshold = 0.001, max_iter = 50, resolution = 1.0
     changeModularity = 1
     iterations = 0
     while changeModularity > Q_threshold and iterations < max_iter:
-        graph, comm = LouvainPhase2(graph, comm)
+        graph, comm = LouvainPhase2Sparse(graph, comm)
         commRefList.append(list(comm))
-        modularity_past = getModularity(graph, comm, resolution) # Note: we want to compare Q before and after reassignments in phase 1
-        comm = LouvainPhase1(graph, comm, Q_threshold, max_iter, resolution)
+        modularity_past = getModularitySparse(graph, comm, resolution) # Note: we want to compare Q before and after reassignments in phase 1
+        comm = LouvainPhase1Sparse(graph, comm, Q_threshold, max_iter, resolution)
         communityAssignmentRecord.append(list(comm))
-        modularity_curr = getModularity(graph, comm, resolution)
+        modularity_curr = getModularitySparse(graph, comm, resolution)
         changeModularity = modularity_curr - modularity_past
         iterations += 1
 #        print('changeModularity', changeModularity)
 
     for i in range(len(communityAssignmentRecord) - 2, 0, -1):
-        changeDict = {}
-        for j in range(len(communityAssignmentRecord[i])):
-            newComm = communityAssignmentRecord[i][j]
-            oldComm = commRefList[i][j]
-            if newComm != oldComm:
-                changeDict[oldComm] = newComm # Change key to value
-        
-        for key in changeDict:
-            oldIndices = [x for x in range(len(communityAssignmentRecord[i - 1])) if communityAssignmentRecord[i - 1][x] == key]
-            for j in oldIndices:
-                communityAssignmentRecord[i - 1][j] = changeDict[key]
+        changes = [(oldComm, newComm) for oldComm, newComm in zip(commRefList[i], communityAssignmentRecord[i]) if newComm != oldComm]
+        communityAssignmentRecord[i - 1] = relabelCommunities(communityAssignmentRecord[i - 1], changes)
     return communityAssignmentRecord[0]
@@ -9,65 +9,68 @@
 
 import numpy as np
 
-def averageLinkage(rmsdMatrix, clusterXmembers, clusterYmembers):
-    subgraph = rmsdMatrix[clusterXmembers,:][:,clusterYmembers]
-    return np.mean(subgraph)
-
-def spread(rmsdMatrix, members):
-    subgraph = rmsdMatrix[members,:][:,members]
-    N = len(members)
-    offDiagonalSum = np.sum(subgraph) / 2 # note: diagonals are zero
-    return offDiagonalSum / (N * (N-1) / 2)
-
-def memberIndices(communityID, communityAssignment):
-    indices = [x for x in range(len(communityAssignment)) if communityAssignment[x] == communityID]
-    return indices
-
-def averageSpread(rmsdMatrix, communityAssignment):
-    communities = list(set(communityAssignment))
-    spreads = [spread(rmsdMatrix, memberIndices(C, communityAssignment)) for C in communities]
-    return np.mean(spreads)
-
-def mergeClusters(rmsdMatrix, communityAssignment, aveLinkArray = None):
-    communities = list(set(communityAssignment))
-    numCommunities = len(communities)
-    if type(aveLinkArray) == type(None):
-        aveLinkArray = np.zeros([numCommunities, numCommunities])
-        for i in range(numCommunities - 1):
-            for j in range(i + 1, numCommunities):
-                i_members = memberIndices(communities[i], communityAssignment)
-                j_members = memberIndices(communities[j], communityAssignment)
-                aveLinkVal = averageLinkage(rmsdMatrix, i_members, j_members)
-                aveLinkArray[i,j] = aveLinkVal
-                aveLinkArray[j,i] = aveLinkVal
-
-    # Populate diagonals (self similarity) with max average linkage value to remove it from consideration.
-    aveLinkArray[range(numCommunities), range(numCommunities)] = np.max(aveLinkArray) + 0.01
-    minVal = np.min(aveLinkArray)
-    # Find value of minimum average linkage. Keep only the first index
-    i, j = np.where(aveLinkArray == minVal)
-    i = i[0]
-    j = j[0]
-    # Merge communities as recorded on communityAssignment
-    C = communities[i]
-    G = communities[j]
-    i_members=memberIndices(communities[i], communityAssignment)
-    j_members=memberIndices(communities[j], communityAssignment)
-    for mem in j_members:
-        communityAssignment[mem] = C
-
-    for k in range(numCommunities):
-        if communities[k] in [C, G]:
-            continue
-        k_members = memberIndices(communities[k], communityAssignment)
-        aveLinkVal = averageLinkage(rmsdMatrix, i_members+j_members, k_members)
-        aveLinkArray[i, k] = aveLinkVal
-        aveLinkArray[k, i] = aveLinkVal
-
-    aveLinkArray = np.delete(aveLinkArray, j, 0)
-    aveLinkArray = np.delete(aveLinkArray, j, 1)
-
-    return communityAssignment, aveLinkArray
+def spread(withinSum, N):
+    # Mean RMSD over the pairs of members of a cluster of N members, from the sum over its pairs
+    return withinSum / (N * (N-1) / 2)
+
+def mergeLogAssignment(merges, N):
+    # Community assignment after the given merges, each conformer labeled by the lowest index of its cluster
+    parent = np.arange(N)
+    for C, G, linkage in merges:
+        parent[G] = C
+    # follow parents to the root of each cluster, halving the remaining path at each pass
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent.tolist()
+        parent = grandparent
+
+def nearestAbove(distances, k):
+    # Closest cluster of higher label than cluster k (first among ties) and its average linkage. np.inf if none
+    row = distances[k, k + 1:]
+    if len(row) == 0:
+        return k, np.inf
+    nearest = int(np.argmin(row))
+    return k + 1 + nearest, row[nearest]
+
+def averageLinkageMerges(rmsdMatrix):
+    # Merge sequence of average linkage clustering, from single conformers to one cluster.
+    # Each cluster is labeled by its lowest member index, and each merge joins the pair of clusters of minimum average
+    # linkage, the pair of lowest labels among ties. Average linkages to the merged cluster are the size weighted averages of
+    # the linkages to its two parts (Lance-Williams update), and the nearest cluster of higher label is cached for each
+    # cluster, so that each merge updates one row of the linkage matrix and rescans only the rows whose nearest cluster
+    # was merged: O(n^2) time overall instead of recomputing linkages from the RMSD matrix.
+    # output: list of (kept label, absorbed label, average linkage) for each merge
+    distances = np.array(rmsdMatrix, dtype = float)
+    N = distances.shape[0]
+    np.fill_diagonal(distances, np.inf)
+    sizes = np.ones(N)
+    nearest = np.arange(N)
+    nearestDist = np.full(N, np.inf)
+    for k in range(N - 1):
+        nearest[k], nearestDist[k] = nearestAbove(distances, k)
+    merges = []
+    for step in range(N - 1):
+        i = int(np.argmin(nearestDist))
+        j = int(nearest[i])
+        merges.append((i, j, nearestDist[i]))
+        merged = (sizes[i] * distances[i] + sizes[j] * distances[j]) / (sizes[i] + sizes[j])
+        merged[[i, j]] = np.inf
+        distances[i, :] = merged
+        distances[:, i] = merged
+        distances[j, :] = np.inf
+        distances[:, j] = np.inf
+        sizes[i] += sizes[j]
+        nearestDist[j] = np.inf
+        # rows below i whose nearest cluster was merged are rescanned, the others may now be nearest to i
+        stale = np.flatnonzero((nearest[:i] == i) | (nearest[:i] == j)).tolist()
+        closer = (merged[:i] < nearestDist[:i]) | ((merged[:i] == nearestDist[:i]) & (nearest[:i] > i))
+        nearest[:i][closer] = i
+        nearestDist[:i][closer] = merged[:i][closer]
+        stale += (i + 1 + np.flatnonzero(nearest[i + 1:j] == j)).tolist()
+        for k in [i] + stale:
+            nearest[k], nearestDist[k] = nearestAbove(distances, k)
+    return merges
 
 def normalizeAvSpVal(AvSpVal, AvSpMax, AvSpMin, N):
     return (N - 1) / (AvSpMax - AvSpMin) * (AvSpVal - AvSpMin) + 1
@@ -82,30 +85,39 @@ def normalizeAvSp(AvSpList, N):
 def NMRCLUST_(rmsdMatrix):
     N = rmsdMatrix.shape[0]
     AvSpList = []
-    assignList = []
-    aveLinkArray = None
-    communityAssignment = list(range(N))
+    nClustList = []
+    merges = averageLinkageMerges(rmsdMatrix)
+    # size of each cluster and sum of RMSD over the pairs of its members, kept under its label. Merging adds the sum over
+    # the pairs across the two clusters, which is their average linkage times the number of such pairs
+    sizes = [1] * N
+    withinSums = [0.0] * N
+    spreadSum = 0.0 # sum of the spreads of clusters of at least 2 members
+    numClusters = N
+    numSingletons = N
     singletonPresent = True # spread cannot be calculated if size of cluster is 1. Avoid spread calculation until each cluster has at least 2 members
-    while singletonPresent:
-        communityAssignment, aveLinkArray = mergeClusters(rmsdMatrix, communityAssignment, aveLinkArray)
-        communities = list(set(communityAssignment))
-        commcount = [len([x for x in communityAssignment if x == C]) for C in communities]
-        if 1 not in commcount:
-            singletonPresent = False
-        elif len(communities) == 2:
-            singletonPresent = False
-    
-    # Begin recording Average spread and cumminities assignment once singletons are absent
-    # Continue recording until all are merged into one cluster
-    while len(set(communityAssignment)) > 1:
-        communityAssignment, aveLinkArray = mergeClusters(rmsdMatrix, communityAssignment, aveLinkArray)
-        AvSpList.append(float(averageSpread(rmsdMatrix, communityAssignment)))
-        assignList.append(list(communityAssignment))
+    for step, (C, G, linkage) in enumerate(merges):
+        numSingletons -= (sizes[C] == 1) + (sizes[G] == 1)
+        for label in [C, G]:
+            if sizes[label] > 1:
+                spreadSum -= spread(withinSums[label], sizes[label])
+        withinSums[C] += withinSums[G] + linkage * sizes[C] * sizes[G]
+        sizes[C] += sizes[G]
+        spreadSum += spread(withinSums[C], sizes[C])
+        numClusters -= 1
+        if singletonPresent:
+            if numSingletons == 0 or numClusters == 2:
+                singletonPresent = False
+                firstRecorded = step + 1
+            continue
+        # Begin recording Average spread and number of clusters once singletons are absent
+        # Continue recording until all are merged into one cluster
+        AvSpList.append(spreadSum / numClusters)
+        nClustList.append(numClusters)
 
-    nClustList = [len(set(x)) for x in assignList] # number of clusters from when it was began recoded to one cluster, decreasing by one cluster at each step
     AvSpNormList = normalizeAvSp(AvSpList, N)
     penaltyVals = [AvSpNormList[x] + nClustList[x] for x in range(len(AvSpNormList))]
     minPenalty = np.min(penaltyVals)
     minPenaltyIndex = penaltyVals.index(minPenalty)
 
-    return assignList[minPenaltyIndex]
+    # only the selected level is built, from the merges up to it
+    return mergeLogAssignment(merges[:firstRecorded + minPenaltyIndex + 1], N)
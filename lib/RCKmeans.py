@@ -4,29 +4,59 @@
 
 # We consider the use of representative conformation K-means to benchmark against AutoGraph as a method which does not require specification of number of clusters or threshold.
 # Original algorithm found at DOI: 10.1186/s13321-017-0208-0
+# Assignment, medoid update, and scores are array operations on the RMSD matrix: each step reads the columns of the medoids
+# and the submatrix of each cluster once (in blocks of rows), so that an iteration takes O(n^2) time without n^2 temporaries.
+# The restarts for each k are distributed over a process pool attached to the RMSD matrix in shared memory. Each restart
+# draws its initial medoids from its own random stream spawned from a single seed, so results do not depend on n_jobs.
 
 import numpy as np
-from random import sample
 from math import factorial
+from multiprocessing import Pool
+from .parallel import numWorkers, createSharedArray, attachSharedArray, releaseSharedArray
 
-def kmedoid(rmsdMatrix, k = 2):
+def assignToMedoids(rmsdMatrix, medoids):
+    # Index of the closest medoid of each conformer (first among ties). Each medoid is assigned to its own cluster
+    classification = np.argmin(rmsdMatrix[:, medoids], axis = 1)
+    classification[medoids] = np.arange(len(medoids))
+    return classification
+
+def clusterSums(rmsdMatrix, classification, k, block_size = 1 << 22):
+    # Medoid of each of the k clusters (member of minimum sum of RMSD to the other members, lowest index among ties),
+    # sum of RMSD over the ordered pairs of its members, and its size
+    # block_size: (int) number of elements of the submatrix of a cluster read at once
+    order = np.argsort(classification, kind = 'stable')
+    bounds = np.searchsorted(classification[order], np.arange(k + 1))
+    medoids = np.empty(k, dtype = int)
+    withinSums = np.empty(k)
+    for j in range(k):
+        members = order[bounds[j]:bounds[j + 1]]
+        columnSums = np.zeros(len(members))
+        rows = max(1, block_size // max(1, len(members)))
+        for start in range(0, len(members), rows):
+            columnSums += rmsdMatrix[np.ix_(members[start:start + rows], members)].sum(axis = 0)
+        medoids[j] = members[np.argmin(columnSums)]
+        withinSums[j] = columnSums.sum()
+    return medoids, withinSums, np.diff(bounds)
+
+def kmedoid(rmsdMatrix, k = 2, rng = None, max_iter = 100):
     # Generic k-medoid function with rmsd matrix as input
+    # rng: (numpy Generator) source of the initial medoids. A new unseeded generator if None
+    # output: cluster index of each conformer (list of int) and the medoid of each cluster (list of int)
+    if rng is None:
+        rng = np.random.default_rng()
     n = rmsdMatrix.shape[0]
-    medoids = sample(range(n), k)
-    prev_medoids = []
-    classification = np.zeros(n, dtype = int).tolist()
-    while medoids != prev_medoids:
-        for i in range(n):
-            prev_medoids = medoids
-            min_index = np.argmin(rmsdMatrix[i,:][medoids])
-            classification[i] = min_index
-        for j in range(k):
-            members = [x for x in range(n) if classification[x] == j]
-            sub_rmsd = rmsdMatrix[members,:][:, members]
-            center_index = np.argmin(np.sum(sub_rmsd, axis = 0))
-            medoids[j] = center_index
-
-    return classification, medoids
+    medoids = rng.choice(n, k, replace = False)
+    for iteration in range(max_iter):
+        classification = assignToMedoids(rmsdMatrix, medoids)
+        updated = clusterSums(rmsdMatrix, classification, k)[0]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    else:
+        # not converged within max_iter: assign the conformers to the last medoids
+        classification = assignToMedoids(rmsdMatrix, medoids)
+
+    return classification.tolist(), medoids.tolist()
 
 def comb(n, r):
     if n < r:
@@ -37,33 +67,74 @@ def MSQb(rmsdMatrix, medoids):
     sub_rmsd = rmsdMatrix[medoids, :][:, medoids]
     return np.sum(sub_rmsd) / (2 * comb(len(medoids), 2))
 
-def MSQw(rmsdMatrix,classification):
-    tally = 0
-    n = len(classification)
-    for i in set(classification):
-        members = [x for x in range(n) if classification[x] == i]
-        sub_rmsd = rmsdMatrix[members, :][:, members]
-        tally += np.sum(sub_rmsd) / (2 * comb(len(members), 2))
-    return tally / len(set(classification))
+def MSQw(rmsdMatrix, classification):
+    # Mean over clusters of the mean RMSD between pairs of members (0 for single conformers)
+    labels = np.unique(classification, return_inverse = True)[1].ravel()
+    withinSums, sizes = clusterSums(rmsdMatrix, labels, labels.max() + 1)[1:]
+    pairs = np.where(sizes > 1, sizes * (sizes - 1), 2)
+    return np.mean(withinSums / pairs)
 
 def SMA(MSQb_list, W = 10):
     if len(MSQb_list) >= W:
-        return np.mean(MSQb_list[-10:])
+        return np.mean(MSQb_list[-W:])
     return -1
 
-def RCKmeans_(rmsdMatrix):
+_worker = {}
+
+def _initRestartWorker(spec):
+    # Attach the shared RMSD matrix once per worker process
+    _worker['rmsdMatrix'] = attachSharedArray(spec)
+
+def restartScores(rmsdMatrix, k, seedSequence):
+    # MSQw and MSQb of one k-medoid restart, and its medoids
+    classification, medoids = kmedoid(rmsdMatrix, k, np.random.default_rng(seedSequence))
+    return MSQw(rmsdMatrix, classification), MSQb(rmsdMatrix, medoids), medoids
+
+def _restartWorker(task):
+    return restartScores(_worker['rmsdMatrix'][1], *task)
+
+def RCKmeans_(rmsdMatrix, restarts = 100, n_jobs = 1, seed = None):
+    # inputs
+    # rmsdMatrix: (numpy array) RMSD matrix between conformers
+    # restarts: (int) number of k-medoid runs for each k. The run of lowest MSQw gives the MSQb of k
+    # n_jobs: (int) number of processes running the restarts. -1 uses all cores. Results are identical to the serial mode
+    # seed: (int) seed of the random streams of the restarts
+    # output: cluster index of each conformer and the medoid of each cluster, for the k of maximum MSQb. A single cluster
+    # if no k above 1 separates the conformers (fewer than 3 conformers, or MSQb of 0 for all k)
     m = rmsdMatrix.shape[0]
-    K_MSQb = [0, 0]
-    prevSMA = -1
-    for k in range(2,m):
-        MSQw_list = np.zeros(100, dtype = int).tolist()
-        MSQb_list = np.zeros(100, dtype = int).tolist()
-        for i in range(100):
-            classification, medoids = kmedoid(rmsdMatrix, k)
-            MSQw_list[i] = MSQw(rmsdMatrix, classification)
-            MSQb_list[i] = MSQb(rmsdMatrix, medoids)
-        K_MSQb.append(MSQb_list[np.argmin(MSQw_list)])
-        currSMA = SMA(K_MSQb, 10)
-        if currSMA < prevSMA:
-            return kmedoid(rmsdMatrix, np.argmax(K_MSQb))
-        prevSMA = currSMA
+    seedSequence = np.random.SeedSequence(seed)
+    processes = min(numWorkers(n_jobs), restarts)
+    pool = shm = None
+    if processes > 1:
+        shm, shared, spec = createSharedArray(rmsdMatrix)
+        del shared
+        pool = Pool(processes, initializer = _initRestartWorker, initargs = (spec,))
+    try:
+        K_MSQb = [0, 0]
+        K_medoids = [None, None]
+        prevSMA = -1
+        for k in range(2,m):
+            tasks = [(k, stream) for stream in seedSequence.spawn(restarts)]
+            if pool is None:
+                scores = [restartScores(rmsdMatrix, *task) for task in tasks]
+            else:
+                scores = pool.map(_restartWorker, tasks, chunksize = max(1, restarts // (4 * processes)))
+            MSQw_list, MSQb_list, medoids_list = zip(*scores)
+            best = int(np.argmin(MSQw_list))
+            K_MSQb.append(MSQb_list[best])
+            K_medoids.append(medoids_list[best])
+            currSMA = SMA(K_MSQb, 10)
+            if currSMA < prevSMA:
+                break
+            prevSMA = currSMA
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            releaseSharedArray(shm)
+
+    # clusters of the best restart at the k of maximum MSQb
+    medoids = K_medoids[int(np.argmax(K_MSQb))]
+    if medoids is None:
+        return [0] * m, clusterSums(rmsdMatrix, np.zeros(m, dtype = int), 1)[0].tolist()
+    return assignToMedoids(rmsdMatrix, medoids).tolist(), medoids
@@ -0,0 +1,48 @@
+# 2021-07-05
+
+# Kiyoto Aramis Tanemura
+
+# Index of the members of each community, built once after clustering and shared by centroid selection, cluster statistics,
+# the cluster summary, and the export of conformers. Conformers are sorted by community with one stable argsort. The members of
+# the k-th community in ascending order are order[offsets[k]:offsets[k + 1]], in the order of fileList. Communities are listed
+# in the order of list(set(communityAssignment)), the order in which the original centroid selection visited them, so that
+# clusters of equal size are numbered as before. Integer labels hash to themselves, so this order is the same in every run.
+# It differs from ascending order when labels are not contiguous (e.g. Louvain labels are node indices).
+
+import numpy as np
+
+class CommunityIndex:
+    '''Members of each community of a community assignment.\ncommunities: (list) community labels, in the order of list(set(communityAssignment))\nsizes: (numpy array) number of members of each community of communities\norder: (numpy array) conformer indices sorted by community\noffsets: (numpy array) start of each community in order, communities in ascending order, followed by the number of conformers'''
+
+    def __init__(self, communityAssignment, fileList):
+        '''communityAssignment: (list of int) community assigned to each conformer\nfileList: (list of string) names of the conformers corresponding to communityAssignment by index'''
+        self.labels = np.asarray(communityAssignment)
+        self.fileList = fileList
+        self.order = np.argsort(self.labels, kind = 'stable')
+        ascending, starts, counts = np.unique(self.labels[self.order], return_index = True, return_counts = True)
+        self.offsets = np.append(starts, len(self.labels))
+        self.rank = {C: k for k, C in enumerate(ascending.tolist())}
+        self.communities = list(set(self.labels.tolist()))
+        self.sizes = counts[[self.rank[C] for C in self.communities]]
+        self.position = {x: i for i, x in enumerate(fileList)}
+
+    def describes(self, communityAssignment, fileList):
+        '''Whether the index was built from this community assignment and file list'''
+        return len(communityAssignment) == len(self.labels) and (fileList is self.fileList or list(fileList) == list(self.fileList)) and np.array_equal(np.asarray(communityAssignment), self.labels)
+
+    def members(self, C):
+        '''Indices of the members of community C, in ascending order'''
+        k = self.rank[C]
+        return self.order[self.offsets[k]:self.offsets[k + 1]]
+
+    def memberFiles(self, C):
+        '''File names of the members of community C'''
+        return [self.fileList[x] for x in self.members(C)]
+
+    def indexOf(self, names):
+        '''Indices of the conformers with the given file names'''
+        return [self.position[x] for x in names]
+
+    def communityOf(self, names):
+        '''Communities of the conformers with the given file names'''
+        return [self.labels[self.position[x]].item() for x in names]
@@ -0,0 +1,178 @@
+# 2021-06-21
+
+# Kiyoto Aramis Tanemura
+
+# Content addressed cache of parsed coordinates and RMSD matrices, shared by AutoGraph, NMRCLUST, RCKmeans, and DynamicTreeCut.
+# Conformers are identified by the hash of their file (or frame) content, so the cache is valid whatever the file names, their order,
+# or the output directory. Entries are also keyed by the options that change the result: the atom filters (hetatm, keepH),
+# the version of the parsers, and the name and version of the RMSD kernel. Bump the versions below when a change alters parsed coordinates or RMSD values.
+# Each entry is a set of conformers. A request is served from the entry sharing the most conformers with it, and only the
+# missing conformers are parsed (or the missing pairs computed). An entry whose conformers are all covered by a newer entry is removed.
+# The cache directory may be deleted at any time. If it cannot be written (e.g. read-only), results are computed without it.
+
+import os
+import hashlib
+import numpy as np
+from .functions import loadCoordinates, fileHashes
+from .matrixStore import saveMatrix, loadMatrix, denseFromCondensed
+
+PARSER_VERSION = 1
+KERNEL_VERSION = 1
+
+def defaultCacheDir():
+    # Cache location of the user: $XDG_CACHE_HOME/autograph, or ~/.cache/autograph
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'autograph') + '/'
+
+def resolveCacheDir(cache_dir):
+    # Translate the cache_dir argument of the clustering classes. None disables the cache, '' uses the user cache directory
+    if cache_dir is None:
+        return None
+    if cache_dir == '':
+        return defaultCacheDir()
+    return cache_dir if cache_dir[-1] == '/' else cache_dir + '/'
+
+def optionsKey(kind, hetatm, keepH, kernel = 'qcp'):
+    # Short key of the options an entry depends on
+    versions = 'parser%d' %PARSER_VERSION if kind == 'coords' else 'parser%d-%s%d' %(PARSER_VERSION, kernel, KERNEL_VERSION)
+    return hashlib.sha1(('%s-%s-hetatm%d-keepH%d' %(kind, versions, hetatm, keepH)).encode()).hexdigest()[:12]
+
+def setKey(hashes):
+    # Key of an entry: digest of the conformer hashes it holds
+    return hashlib.sha1('\n'.join(hashes).encode()).hexdigest()[:16]
+
+def readIndex(path):
+    with open(path, 'r') as f:
+        return f.read().splitlines()
+
+def findEntry(cache_dir, prefix, hashes):
+    # Return the path (without extension) and hashes of the entry sharing the most conformers with hashes, or None
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return None, []
+    needed = set(hashes)
+    bestPath, bestHashes, bestOverlap = None, [], 0
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith('.index')):
+            continue
+        path = cache_dir + name[:-len('.index')]
+        try:
+            storedHashes = readIndex(path + '.index')
+        except OSError:
+            continue
+        overlap = len(needed.intersection(storedHashes))
+        if overlap > bestOverlap:
+            bestPath, bestHashes, bestOverlap = path, storedHashes, overlap
+    return bestPath, bestHashes
+
+def removeSuperseded(cache_dir, prefix, hashes, keep):
+    # Remove the entries whose conformers are all contained in hashes, except the entry keep
+    covered = set(hashes)
+    for name in os.listdir(cache_dir):
+        if not (name.startswith(prefix) and name.endswith('.index')):
+            continue
+        path = cache_dir + name[:-len('.index')]
+        if path == keep:
+            continue
+        try:
+            if covered.issuperset(readIndex(path + '.index')):
+                for extension in ['.index', '.npy', '.elements.npy']:
+                    if os.path.exists(path + extension):
+                        os.remove(path + extension)
+        except OSError:
+            continue
+
+def replaceFile(path, write):
+    # Write a file under a temporary name, then move it in place so that concurrent readers never see a partial file
+    temporary = path + '.%d.tmp' %os.getpid()
+    with open(temporary, 'wb') as f:
+        write(f)
+    os.replace(temporary, path)
+
+def cachedCoordinates(fileList, inpath, hetatm = True, keepH = False, cache_dir = None, hashes = None):
+    # Same as loadCoordinates, reading the coordinates of conformers already parsed from the cache.
+    # hashes: (list of string) content hashes of fileList (see fileHashes), computed if not given
+    # output: (n_files, n_atoms, 3) numpy array of coordinates and (n_files, n_atoms) numpy array of elements
+    if cache_dir is None:
+        return loadCoordinates(fileList, inpath, hetatm, keepH)
+    if hashes is None:
+        hashes = fileHashes(fileList, inpath)
+    prefix = 'coords-' + optionsKey('coords', hetatm, keepH) + '-'
+    path, storedHashes = findEntry(cache_dir, prefix, hashes)
+    if path is not None:
+        try:
+            cachedCoords = np.load(path + '.npy', mmap_mode = 'r')
+            cachedElements = np.load(path + '.elements.npy', mmap_mode = 'r')
+        except (OSError, ValueError):
+            # unreadable entry: parse all conformers again
+            path, storedHashes = None, []
+    position = {h: i for i, h in enumerate(storedHashes)}
+    missing = [i for i, h in enumerate(hashes) if h not in position]
+    if path is not None and len(missing) == 0:
+        rows = [position[h] for h in hashes]
+        return np.array(cachedCoords[rows]), np.array(cachedElements[rows])
+    newCoords, newElements = loadCoordinates([fileList[i] for i in missing], inpath, hetatm, keepH)
+    if len(missing) < len(fileList):
+        if cachedCoords.shape[1] != newCoords.shape[1]:
+            raise ValueError('Conformers do not have the same number of atoms: %d atoms cached, %d atoms read' %(cachedCoords.shape[1], newCoords.shape[1]))
+        coords = np.empty([len(fileList), newCoords.shape[1], 3])
+        elements = np.empty([len(fileList), newCoords.shape[1]], dtype = np.result_type(cachedElements.dtype, newElements.dtype))
+        found = [i for i, h in enumerate(hashes) if h in position]
+        rows = [position[hashes[i]] for i in found]
+        coords[found] = cachedCoords[rows]
+        elements[found] = cachedElements[rows]
+        coords[missing] = newCoords
+        elements[missing] = newElements
+        del cachedCoords, cachedElements
+    else:
+        coords, elements = newCoords, newElements
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        newPath = cache_dir + prefix + setKey(hashes)
+        replaceFile(newPath + '.npy', lambda f: np.save(f, coords))
+        replaceFile(newPath + '.elements.npy', lambda f: np.save(f, elements))
+        replaceFile(newPath + '.index', lambda f: f.write(('\n'.join(hashes) + '\n').encode()))
+        removeSuperseded(cache_dir, prefix, hashes, newPath)
+    except OSError:
+        # the cache is optional: keep the parsed coordinates without saving them
+        pass
+    return coords, elements
+
+def rmsdPrefix(hetatm, keepH, kernel):
+    return 'rmsd-' + optionsKey('rmsd', hetatm, keepH, kernel) + '-'
+
+def cachedRmsdCovers(cache_dir, hashes, hetatm = True, keepH = False, kernel = 'qcp'):
+    # Whether an entry of the cache holds the RMSD values between all conformers with the given content hashes
+    return set(findEntry(cache_dir, rmsdPrefix(hetatm, keepH, kernel), hashes)[1]).issuperset(hashes)
+
+def readCachedRmsd(cache_dir, fileList, hashes, hetatm = True, keepH = False, kernel = 'qcp'):
+    # Look up RMSD values between the conformers of fileList in the cache.
+    # output: list of the files of fileList (in that order) found in the best entry, and the dense RMSD matrix between them
+    prefix = rmsdPrefix(hetatm, keepH, kernel)
+    path, storedHashes = findEntry(cache_dir, prefix, hashes)
+    if path is None:
+        return [], None
+    stored = set(storedHashes)
+    found = [i for i, h in enumerate(hashes) if h in stored]
+    try:
+        condensed, storedList, _ = loadMatrix(path)
+        known = denseFromCondensed(condensed, storedList, [hashes[i] for i in found])
+    except (OSError, ValueError):
+        return [], None
+    return [fileList[i] for i in found], known
+
+def writeCachedRmsd(cache_dir, matrix, hashes, hetatm = True, keepH = False, kernel = 'qcp'):
+    # Save the RMSD matrix between conformers with the given content hashes to the cache. Nothing is saved if the
+    # cache cannot be written
+    prefix = rmsdPrefix(hetatm, keepH, kernel)
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        newPath = cache_dir + prefix + setKey(hashes)
+        temporary = newPath + '.%d.tmp' %os.getpid()
+        saveMatrix(temporary, matrix, hashes)
+        os.replace(temporary + '.npy', newPath + '.npy')
+        os.replace(temporary + '.index', newPath + '.index')
+        removeSuperseded(cache_dir, prefix, hashes, newPath)
+    except OSError:
+        pass
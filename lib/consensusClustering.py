@@ -0,0 +1,95 @@
+# 2021-07-26
+
+# Kiyoto Aramis Tanemura
+
+# Consensus of several runs of community detection on the same graph (Lancichinetti, A.; Fortunato, S. Sci. Rep. 2012, 2, 336.
+# DOI: 10.1038/srep00336). Louvain and Leiden depend on the order in which nodes are visited, so each run visits the nodes
+# in a different random permutation. Runs are distributed over a process pool, each worker receiving the CSR graph once.
+# Co-assignment frequencies are only needed between conformers joined by an edge of the filtered graph, so memory scales
+# with the number of edges. The consensus graph keeps the edges whose endpoints are clustered together in at least
+# threshold of the runs, weighted by that frequency, and is clustered once more with the same algorithm.
+
+import numpy as np
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix, triu
+from .parallel import numWorkers
+
+_worker = {}
+
+def permutedClustering(graph, permutation, method, Q_threshold = 0.0, max_iter = 50, resolution = 1.0):
+    # Run method visiting the nodes in the order of permutation
+    # output: (numpy array) community of each node, in the original node order
+    permuted = graph[permutation, :][:, permutation]
+    assignment = np.empty(len(permutation), dtype = int)
+    assignment[permutation] = method(permuted, Q_threshold = Q_threshold, max_iter = max_iter, resolution = resolution)
+    return assignment
+
+def _initConsensusWorker(graph, method, Q_threshold, max_iter, resolution):
+    _worker['graph'] = graph
+    _worker['method'] = method
+    _worker['options'] = (Q_threshold, max_iter, resolution)
+
+def _consensusRunWorker(permutation):
+    return permutedClustering(_worker['graph'], permutation, _worker['method'], *_worker['options'])
+
+def multiStartClustering(affinityMatrix, n_starts, method, n_jobs = 1, seed = None, Q_threshold = 0.0, max_iter = 50, resolution = 1.0):
+    # Cluster the same graph n_starts times with different node orders
+    # inputs
+    # affinityMatrix: (numpy array or scipy.sparse matrix) filtered affinity matrix
+    # n_starts: (int) number of runs. The first run visits nodes in their original order
+    # method: (function) community detection with the signature of Louvain
+    # n_jobs: (int) number of processes. -1 uses all cores. Results are identical to the serial mode
+    # seed: (int) seed of the random node permutations
+    # output: (n_starts, n) numpy array of community assignments
+    graph = csr_matrix(affinityMatrix, dtype = float)
+    num_nodes = graph.shape[0]
+    rng = np.random.default_rng(seed)
+    permutations = [np.arange(num_nodes)] + [rng.permutation(num_nodes) for x in range(n_starts - 1)]
+    processes = min(numWorkers(n_jobs), n_starts)
+    if processes <= 1:
+        _initConsensusWorker(graph, method, Q_threshold, max_iter, resolution)
+        assignments = list(map(_consensusRunWorker, permutations))
+    else:
+        with Pool(processes, initializer = _initConsensusWorker, initargs = (graph, method, Q_threshold, max_iter, resolution)) as pool:
+            assignments = pool.map(_consensusRunWorker, permutations)
+    return np.array(assignments)
+
+def coassignmentGraph(affinityMatrix, assignments):
+    # Fraction of the runs clustering both ends of each edge of the graph together
+    # output: (scipy.sparse CSR matrix) symmetric matrix of co-assignment frequencies on the edges of affinityMatrix
+    upper = triu(csr_matrix(affinityMatrix), k = 1).tocoo()
+    counts = np.zeros(len(upper.data))
+    for assignment in assignments:
+        counts += assignment[upper.row] == assignment[upper.col]
+    frequency = csr_matrix((counts / len(assignments), (upper.row, upper.col)), shape = upper.shape)
+    return (frequency + frequency.T).tocsr()
+
+def consensusPartition(affinityMatrix, assignments, method, threshold = 0.5, Q_threshold = 0.0, max_iter = 50, resolution = 1.0):
+    # Cluster the graph of co-assignment frequencies of at least threshold
+    # output: (list of int) consensus community of each node
+    consensusGraph = coassignmentGraph(affinityMatrix, assignments)
+    consensusGraph.data[consensusGraph.data < threshold] = 0
+    consensusGraph.eliminate_zeros()
+    if consensusGraph.nnz == 0:
+        return list(range(consensusGraph.shape[0]))
+    return method(consensusGraph, Q_threshold = Q_threshold, max_iter = max_iter, resolution = resolution)
+
+def clusterStability(communityAssignment, assignments):
+    # Stability of each consensus cluster: fraction of the runs clustering a pair of its members together, averaged over all pairs
+    # output: dict of the stability of each community (nan for single conformers) and the stability over the pairs of all communities
+    labels = np.unique(communityAssignment, return_inverse = True)[1].ravel()
+    numCommunities = labels.max() + 1
+    sizes = np.bincount(labels, minlength = numCommunities).astype(float)
+    pairs = sizes * (sizes - 1)
+    together = np.zeros(numCommunities)
+    for assignment in assignments:
+        # conformers sharing the consensus community and the community of this run
+        runLabels = np.unique(assignment, return_inverse = True)[1].ravel()
+        overlap = np.bincount(labels * (runLabels.max() + 1) + runLabels)
+        cells = np.flatnonzero(overlap)
+        together += np.bincount(cells // (runLabels.max() + 1), weights = overlap[cells] * (overlap[cells] - 1.0), minlength = numCommunities)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        stability = together / (len(assignments) * pairs)
+    communities = np.unique(communityAssignment).tolist()
+    pooled = together.sum() / (len(assignments) * pairs.sum()) if pairs.sum() > 0 else np.nan
+    return {C: stability[k] for k, C in enumerate(communities)}, pooled
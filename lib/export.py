@@ -0,0 +1,131 @@
+# 2021-06-28
+
+# Kiyoto Aramis Tanemura
+
+# Export of clustered conformers into one directory (or archive) per cluster and a directory of centroids.
+# All file operations run in process, without spawning shell commands, so that paths may contain spaces and
+# tens of thousands of conformers are exported in seconds. Files are placed by a pool of threads.
+
+import os
+import time
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from .functions import isEnsemble, iterFrameContents
+from .communityIndex import CommunityIndex
+
+exportModes = ['copy', 'hardlink', 'symlink', 'tar', 'zip']
+
+def clusterMembers(fileList, communityAssignments, centralNodes, communityIndex = None):
+    # Return the list of members of the cluster of each centroid, in the order of fileList
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignments, fileList)
+    return [communityIndex.memberFiles(C) for C in communityIndex.communityOf(centralNodes)]
+
+def placeFile(source, destination, export_mode = 'copy'):
+    # Copy or link one file. Existing files at destination are replaced. Hard links fall back to a copy if not permitted
+    # (e.g. destination on another file system)
+    # output: size of the file in bytes
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if export_mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+    elif export_mode == 'hardlink':
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy(source, destination)
+    else:
+        shutil.copy(source, destination)
+    return os.path.getsize(source)
+
+def placeFiles(tasks, export_mode = 'copy'):
+    return sum(placeFile(source, destination, export_mode) for source, destination in tasks)
+
+def writeArchive(archivePath, sources, export_mode = 'tar'):
+    # Write the files in sources into one uncompressed tar or zip archive, under their file names
+    # output: total size of the files in bytes
+    if export_mode == 'tar':
+        with tarfile.open(archivePath, 'w') as archive:
+            for source in sources:
+                archive.add(source, arcname = os.path.basename(source))
+    else:
+        with zipfile.ZipFile(archivePath, 'w', zipfile.ZIP_STORED) as archive:
+            for source in sources:
+                archive.write(source, arcname = os.path.basename(source))
+    return sum(os.path.getsize(x) for x in sources)
+
+def save_frames(inpath, outpath, fileList, communityAssignments, centralNodes, cluster_names):
+    # Multi-frame input: write the frames of each cluster into one multi-frame file of the same format in the cluster directory
+    # and the centroid frames into centers/. Frames keep the order of fileList
+    # output: number of frames and bytes written
+    position = {x: i for i, x in enumerate(fileList)}
+    community_list = [communityAssignments[position[x]] for x in centralNodes]
+    name = os.path.basename(inpath)
+    handles = {}
+    for clusterpath, community in zip(cluster_names, community_list):
+        os.makedirs(outpath + clusterpath, exist_ok = True)
+        handles[community] = open(outpath + clusterpath + '/' + name, 'wb')
+    os.makedirs(outpath + 'centers', exist_ok = True)
+    centers = open(outpath + 'centers/' + name, 'wb')
+    centralSet = set(centralNodes)
+    numFrames, numBytes = 0, 0
+    try:
+        for frameId, content in zip(fileList, iterFrameContents(inpath, fileList)):
+            if not content.endswith(b'\n'):
+                content += b'\n'
+            if name.split('.')[-1] == 'sdf' and not content.rstrip().endswith(b'$$$$'):
+                content += b'$$$$\n'
+            community = communityAssignments[position[frameId]]
+            if community in handles:
+                handles[community].write(content)
+                numFrames += 1
+                numBytes += len(content)
+            if frameId in centralSet:
+                centers.write(content)
+                numFrames += 1
+                numBytes += len(content)
+    finally:
+        for h in handles.values():
+            h.close()
+        centers.close()
+    return numFrames, numBytes
+
+def save_outputs(inpath, outpath, fileList, communityAssignments, centralNodes, cluster_names, export_mode = 'copy', n_threads = None, batch_size = 256, communityIndex = None):
+    # Save the conformers of each cluster in a directory named after the cluster, and the centroids in centers/
+    # inputs
+    # export_mode: (string) "copy" copies the files. "hardlink" and "symlink" link to the input files instead, which costs no disk space
+    # (a hard link falls back to a copy across file systems). "tar" and "zip" write one archive per cluster (e.g. cluster0.tar) and centers.tar
+    # n_threads: (int) number of threads placing files. Default of concurrent.futures.ThreadPoolExecutor if None
+    # batch_size: (int) number of files placed by a thread at a time
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignments if not given
+    # Frames of a multi-frame input file are always written as one multi-frame file per cluster (see save_frames)
+    # output: number of files exported, their size in bytes, and the time taken in seconds
+    if export_mode not in exportModes:
+        raise ValueError('export_mode "%s" not recognized. Use one of %s' %(export_mode, ', '.join(exportModes)))
+    start = time.time()
+    if isEnsemble(inpath):
+        numFiles, numBytes = save_frames(inpath, outpath, fileList, communityAssignments, centralNodes, cluster_names)
+        return numFiles, numBytes, time.time() - start
+    groups = list(zip(cluster_names, clusterMembers(fileList, communityAssignments, centralNodes, communityIndex)))
+    groups.append(('centers', list(centralNodes)))
+    numFiles = sum(len(members) for _, members in groups)
+    with ThreadPoolExecutor(max_workers = n_threads) as executor:
+        if export_mode in ['tar', 'zip']:
+            archives = [outpath + clusterpath + '.' + export_mode for clusterpath, _ in groups]
+            sources = [[inpath + x for x in members] for _, members in groups]
+            numBytes = sum(executor.map(writeArchive, archives, sources, [export_mode] * len(groups)))
+        else:
+            tasks = []
+            for clusterpath, members in groups:
+                os.makedirs(outpath + clusterpath, exist_ok = True)
+                tasks.extend((inpath + x, outpath + clusterpath + '/' + x) for x in members)
+            batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+            numBytes = sum(executor.map(placeFiles, batches, [export_mode] * len(batches)))
+    return numFiles, numBytes, time.time() - start
+
+def exportReport(numFiles, numBytes, seconds):
+    # One line summary of the throughput of save_outputs
+    seconds = max(seconds, 1e-9)
+    return 'Exported %d files (%.1f MB) in %.2f s: %.0f files/s, %.1f MB/s' %(numFiles, numBytes / 1e6, seconds, numFiles / seconds, numBytes / 1e6 / seconds)
@@ -3,49 +3,117 @@
 # Kiyoto Aramis Tanemura
 
 # Find threshold weight such that it is the maximum value while maintaining exactly one component graph
-# input: affinity matrix as numpy array
+# input: affinity matrix as numpy array, its condensed upper triangle, or scipy.sparse matrix
 # output: threshold value as float
+# The graph keeping the edges above a value is connected as long as the value is below the weakest edge (bottleneck) of the
+# maximum spanning tree. The threshold is the largest edge weight below the bottleneck, so all edges of the tree are kept.
+# If no edge weight is below the bottleneck, the threshold is the closest float below it.
+# Dense or condensed matrices already disconnected by zero affinities have no such threshold: as in the original search,
+# the smallest affinity value is returned.
+# Dense and condensed matrices are scanned row by row (Prim's algorithm, O(n^2) time and O(n) additional memory).
+# Sparse graphs use scipy's minimum spanning tree (Kruskal's algorithm with union-find over the sorted edges) on negated weights.
 
 import numpy as np
-from .functions import rbfKernel
-
-def findThreshold(affinityMatrix):
-    numFiles = affinityMatrix.shape[0]
-    # Get all values in affinityMatrix. Sort in descending order
-    vals = np.array([])
-    for i in range(numFiles - 1):
-        vals = np.append(vals, affinityMatrix[i, i + 1:])
-
-    vals = np.sort(vals, axis = None)[::-1]
-
-    # Initialize index values
-    upperIndex = 0
-    lowerIndex = len(vals) - 1
-
-    while upperIndex != lowerIndex - 1: # Until the indices are consecutive, iterate
-        midIndex = int(np.mean([lowerIndex, upperIndex]))
-        adjacencyMatrix = affinityMatrix > vals[midIndex]
-        # Will tally nodes visited from first node in graph by BFS. If not all nodes were visited, there are more than one component.
-        nodesVisited = [0] + [i for i in range(numFiles) if adjacencyMatrix[0, i] == 1]
-#        nodesVisited = [i for i in range(numFiles) if adjacencyMatrix[0, i] == 1]
-        for i in nodesVisited:
-            newNodes = [j for j in range(numFiles) if adjacencyMatrix[i, j] == 1 and j not in nodesVisited]
-            nodesVisited += newNodes
-        while len(newNodes) > 0:
-            newNodes1list = []
-            for i in newNodes:
-                newNodes1 = [j for j in range(numFiles) if adjacencyMatrix[i, j] == 1 and j not in nodesVisited]
-                newNodes1list += newNodes1
-                nodesVisited += newNodes1
-        
-            newNodes = newNodes1list
-
-        # If every node was visited, then we have exactly one component. Otherwise, there are disconnected graphs
-        if len(nodesVisited) < numFiles:
-            upperIndex = midIndex
-        else:
-            lowerIndex = midIndex
+from scipy.sparse import issparse, triu, csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from .matrixStore import condensedIndex
+
+def largestBelow(values, bound, chunk_size = 1 << 24):
+    # Largest element of a 1D array strictly below bound, or None. Scanned in chunks to bound memory
+    largest = None
+    for start in range(0, len(values), chunk_size):
+        chunk = np.asarray(values[start:start + chunk_size])
+        below = chunk[chunk < bound]
+        if len(below) > 0 and (largest is None or below.max() > largest):
+            largest = below.max()
+    return largest
+
+def smallestValue(values, chunk_size = 1 << 24):
+    # Smallest element of a 1D array, scanned in chunks to bound memory
+    return min(np.asarray(values[start:start + chunk_size]).min() for start in range(0, len(values), chunk_size))
+
+def denseRow(affinityMatrix, i, numFiles):
+    # Copy of row i of a dense matrix or of the square form of a condensed upper triangle. The diagonal is zero
+    if affinityMatrix.ndim == 2:
+        return np.array(affinityMatrix[i], dtype = float)
+    others = np.arange(numFiles)
+    row = np.zeros(numFiles)
+    row[others != i] = affinityMatrix[condensedIndex(numFiles, i, others[others != i])]
+    return row
+
+def maximumSpanningTreeDense(affinityMatrix):
+    # Maximum spanning tree of a dense or condensed affinity matrix by Prim's algorithm
+    # output: arrays of the two ends and of the weight of each tree edge. If some conformers are only joined by zero
+    # affinities, the tree spans the component of the first conformer only (fewer than numFiles - 1 edges)
+    if affinityMatrix.ndim == 2:
+        numFiles = affinityMatrix.shape[0]
+    else:
+        numFiles = int(round((1 + np.sqrt(1 + 8 * len(affinityMatrix))) / 2))
+    inTree = np.zeros(numFiles, dtype = bool)
+    inTree[0] = True
+    best = denseRow(affinityMatrix, 0, numFiles)
+    parent = np.zeros(numFiles, dtype = int)
+    rows, cols, weights = [], [], []
+    for step in range(numFiles - 1):
+        best[inTree] = -np.inf
+        j = int(np.argmax(best))
+        if best[j] <= 0:
+            break
+        rows.append(parent[j])
+        cols.append(j)
+        weights.append(best[j])
+        inTree[j] = True
+        row = denseRow(affinityMatrix, j, numFiles)
+        closer = row > best
+        best[closer] = row[closer]
+        parent[closer] = j
+    return np.array(rows, dtype = int), np.array(cols, dtype = int), np.array(weights), numFiles
 
-    threshold = vals[lowerIndex]
+def maximumSpanningTreeSparse(affinityMatrix):
+    # Maximum spanning tree of a sparse affinity graph, from the minimum spanning tree of the negated weights
+    numComponents = connected_components(affinityMatrix > 0, directed = False)[0]
+    if numComponents > 1:
+        raise ValueError('The affinity graph has %d components before applying a threshold. Increase the RMSD cutoff of the sparse graph.' %numComponents)
+    tree = minimum_spanning_tree(-csr_matrix(affinityMatrix, dtype = float)).tocoo()
+    return tree.row, tree.col, -tree.data, affinityMatrix.shape[0]
+
+def findThreshold(affinityMatrix, return_tree = False):
+    # affinityMatrix: (numpy array, condensed numpy array, or scipy.sparse matrix) symmetric affinity matrix with zero diagonal
+    # return_tree: (Boolean) also return the maximum spanning tree as a symmetric scipy.sparse CSR matrix. Its smallest weight
+    #   (the bottleneck) minus the threshold is the margin by which the thresholded graph stays connected
+    # output: threshold, and the tree if return_tree
+    if issparse(affinityMatrix):
+        rows, cols, weights, numFiles = maximumSpanningTreeSparse(affinityMatrix)
+        values = triu(affinityMatrix, 1).tocsr().data
+    else:
+        affinityMatrix = np.asarray(affinityMatrix)
+        rows, cols, weights, numFiles = maximumSpanningTreeDense(affinityMatrix)
+        values = None
+
+    if len(weights) == 0:
+        threshold = 0.0
+    elif len(weights) < numFiles - 1:
+        # disconnected before applying a threshold
+        if affinityMatrix.ndim == 1:
+            threshold = smallestValue(affinityMatrix)
+        else:
+            threshold = min(smallestValue(affinityMatrix[i, i + 1:]) for i in range(numFiles - 1))
+    else:
+        bottleneck = weights.min()
+        # largest edge weight below the bottleneck. If none, the closest float below the bottleneck, so that the
+        # filter keeping the weights strictly above the threshold keeps the bottleneck edge
+        if values is not None:
+            threshold = largestBelow(values, bottleneck)
+        elif affinityMatrix.ndim == 1:
+            threshold = largestBelow(affinityMatrix, bottleneck)
+        else:
+            candidates = [largestBelow(affinityMatrix[i, i + 1:], bottleneck) for i in range(numFiles - 1)]
+            candidates = [x for x in candidates if x is not None]
+            threshold = max(candidates) if len(candidates) > 0 else None
+        if threshold is None:
+            threshold = float(np.nextafter(bottleneck, 0))
 
+    if return_tree:
+        tree = csr_matrix((weights, (rows, cols)), shape = (numFiles, numFiles))
+        return threshold, (tree + tree.T).tocsr()
     return threshold
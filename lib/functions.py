@@ -8,129 +8,316 @@
 import numpy as np
 import pandas as pd
 import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from scipy.sparse import issparse
+from .communityIndex import CommunityIndex
 
-def xyzToArray(xyzFilePath, keepH = False):
-    # Read xyz coordinates into numpy array. Remove hydrogen atoms
-    with open(xyzFilePath, 'r') as f:
-        lines = f.readlines()
-    lines = [x.split() for x in lines]
-    lines = [x for x in lines if len(x) == 4]
-    if keepH:
-        coords = [x[1:4] for x in lines]
-    else:
-        coords = [x[1:4] for x in lines if x[0] != 'H']
-    for i in range(len(coords)):
-        coords[i] = [float(x) for x in coords[i]]
-    return np.array(coords)
+xyzFields = np.dtype([('element', 'U4'), ('coords', 'f8', 3)])
+molFields = np.dtype([('coords', 'f8', 3), ('element', 'U4')])
 
-def pdbToArray(pdbfilePath, hetatm = True, keepH = False):
-    # Read pdb coordinates into numpy array. Remove hydrogen atoms
+def parseFields(lines, fields, usecols = None):
+    # Convert atom lines to a structured array with numpy's C parser. Raises ValueError if a line does not have the expected fields
+    if len(lines) == 0:
+        return np.zeros(0, dtype = fields)
+    return np.loadtxt(lines, dtype = fields, usecols = usecols, comments = None, ndmin = 1)
+
+def parseXyz(text, keepH = False):
+    # Parse the content of an xyz file. Atom lines have exactly four fields: element and x, y, z coordinates
+    # output: (n_atoms, 3) numpy array of coordinates and the corresponding numpy array of elements
+    lines = text.splitlines()
+    try:
+        # standard layout: number of atoms, comment line, then one line per atom
+        numAtoms = int(lines[0])
+        if any(x.strip() for x in lines[numAtoms + 2:]):
+            raise ValueError
+        atoms = parseFields(lines[2:numAtoms + 2], xyzFields)
+        if len(atoms) != numAtoms:
+            raise ValueError
+    except (ValueError, IndexError):
+        atoms = [x.split() for x in lines]
+        atoms = parseFields([' '.join(x) for x in atoms if len(x) == 4], xyzFields)
+    if not keepH:
+        atoms = atoms[atoms['element'] != 'H']
+    return np.ascontiguousarray(atoms['coords']), atoms['element']
+
+def parsePdb(data, hetatm = True, keepH = False):
+    # Parse the content of a pdb file (bytes). Records and coordinates are sliced from fixed columns of a 2D byte array,
+    # and the coordinates of all atoms are converted to float at once
     # hetatm: (Boolean) if True, read coordinates for ATOM and HETATM. If False, read only coordinates ATOM
-    with open(pdbfilePath, 'r') as f:
-        lines = f.readlines()
+    # output: (n_atoms, 3) numpy array of coordinates and the corresponding numpy array of elements
+    lines = np.array(data.splitlines() + [b''])
+    columns = np.frombuffer(lines.tobytes(), dtype = 'u1').reshape(len(lines), -1)
+    if columns.shape[1] < 80:
+        columns = np.pad(columns, ((0, 0), (0, 80 - columns.shape[1])))
 #### Modified 2021-03-05. Bug reading PDB files. updated so that compatible with PDB files formatted as according to Chimera (https://www.cgl.ucsf.edu/chimera/docs/UsersGuide/tutorials/pdbintro.html)
-    lines = [x for x in lines if len(x) > 4]
+    record = np.ascontiguousarray(columns[:, :4]).view('S4').ravel()
     if hetatm:
-        lines = [x for x in lines if x[:4] in ['ATOM', 'HETA']]
+        keep = (record == b'ATOM') | (record == b'HETA')
     else:
-        lines = [x for x in lines if x[:4] == 'ATOM']
+        keep = record == b'ATOM'
     if not keepH:
-        lines = [x for x in lines if x[13] != 'H']
-    coords = [[x[30:38], x[38:46], x[46:54]] for x in lines]
+        keep &= columns[:, 13] != ord('H')
+    columns = columns[keep]
+    coords = np.ascontiguousarray(columns[:, 30:54]).view('S8').astype(float)
 ####
-#    lines = [x.split() for x in lines]
-#    if hetatm:
-#        lines = [x for x in lines if x[0] in ['ATOM', 'HETATM']]
-#    else:
-#        lines =[x for x in lines if x[0] == 'ATOM']
-#    if keepH:
-#        lines = [x for x in lines]
-#    else:
-#        lines = [x for x in lines if x[2][0] != 'H']
-#    coords = [x[6:9] for x in lines]
-    for i in range(len(coords)):
-        coords[i] = [float(x) for x in coords[i]]
-    return np.array(coords)
+    # element symbol from columns 77-78, or from the atom name if absent
+    elements = np.char.strip(np.ascontiguousarray(columns[:, 76:78]).view('S2').ravel())
+    names = np.char.strip(np.ascontiguousarray(columns[:, 12:14]).view('S2').ravel(), b' 0123456789')
+    elements = np.where(elements == b'', names, elements)
+    return coords.reshape(-1, 3), np.char.decode(elements)
 
-def molToArray(molfilePath, keepH = False):
-    with open(molfilePath, 'r') as f:
-        lines = f.readlines()
-    lines = [x.strip() for x in lines[4:]]
-    lines = [x.split() for x in lines]
-    lines = [x for x in lines if len(x)>10]
-    if keepH:
-        coords = [x[:3] for x in lines]
-    else:
-        coords = [x[:3] for x in lines if x[3] != 'H']
-    for i in range(len(coords)):
-        coords[i] = [float(x) for x in coords[i]]
-    return np.array(coords)
+def parseMol(text, keepH = False):
+    # Parse the content of a mol file. Atom block lines have more than ten fields: x, y, z coordinates, element, ...
+    # output: (n_atoms, 3) numpy array of coordinates and the corresponding numpy array of elements
+    lines = text.splitlines()
+    try:
+        # the counts line gives the number of atoms in its first three columns. The atom block follows it
+        numAtoms = int(lines[3][:3])
+        atoms = lines[4:numAtoms + 4]
+        if len(atoms) != numAtoms or any(len(x.split()) <= 10 for x in atoms):
+            raise ValueError
+        atoms = parseFields(atoms, molFields, usecols = (0, 1, 2, 3))
+    except (ValueError, IndexError):
+        atoms = [x.split() for x in lines[4:]]
+        atoms = parseFields([' '.join(x[:4]) for x in atoms if len(x) > 10], molFields)
+    if not keepH:
+        atoms = atoms[atoms['element'] != 'H']
+    return np.ascontiguousarray(atoms['coords']), atoms['element']
 
-def fileToArray(filepath, hetatm = True, keepH=False):
-    # Read xyz or pdb files into numpy arrays
-    file_extension = filepath.split('.')[-1]
-    if file_extension == 'xyz':
-        return xyzToArray(filepath, keepH)
-    elif file_extension == 'pdb':
-        return pdbToArray(filepath, hetatm, keepH)
-    elif file_extension == 'mol':
-        return molToArray(filepath, keepH)
+def parseFrame(content, extension, hetatm = True, keepH = False):
+    # Parse the content (bytes) of one conformer by the format given by the file extension. sdf records are read as mol blocks
+    if extension == 'xyz':
+        return parseXyz(content.decode(), keepH)
+    elif extension == 'pdb':
+        return parsePdb(content, hetatm, keepH)
+    elif extension in ['mol', 'sdf']:
+        return parseMol(content.decode(), keepH)
     else:
-        print('File extension not recognized when reading. Only files with extensions "xyz", "pdb", or "mol" are read and considered.')
+        print('File extension not recognized when reading. Only files with extensions "xyz", "pdb", "mol", or "sdf" are read and considered.')
         print('Program terminated. Either remove exception or modify file path and be sure they correspond to standard xyz or pdb format')
         quit()
 
+def readCoordinates(filepath, hetatm = True, keepH = False):
+    # Read xyz, pdb, or mol file. Return coordinates and elements
+    with open(filepath, 'rb') as f:
+        return parseFrame(f.read(), filepath.split('.')[-1], hetatm, keepH)
+
+def scanFrames(filepath):
+    # Locate the frames of a multi-frame file without parsing them: concatenated xyz, pdb with MODEL/ENDMDL records, or sdf records
+    # separated by "$$$$". A pdb file without MODEL records is a single frame.
+    # output: numpy arrays of the start and end byte offsets of each frame
+    extension = filepath.split('.')[-1]
+    starts, ends = [], []
+    position = 0
+    with open(filepath, 'rb') as f:
+        if extension == 'xyz':
+            for line in f:
+                if line.strip():
+                    # first line of a frame gives the number of atoms. Skip the comment line and the atoms
+                    numAtoms = int(line.split()[0])
+                    starts.append(position)
+                    position += len(line)
+                    for _ in range(numAtoms + 1):
+                        position += len(f.readline())
+                    ends.append(position)
+                else:
+                    position += len(line)
+        elif extension == 'pdb':
+            inModel = False
+            for line in f:
+                if line[:5] == b'MODEL':
+                    starts.append(position)
+                    inModel = True
+                position += len(line)
+                if line[:6] == b'ENDMDL' and inModel:
+                    ends.append(position)
+                    inModel = False
+            if inModel:
+                ends.append(position)
+            if len(starts) == 0:
+                starts, ends = [0], [position]
+        else:
+            start = 0
+            hasContent = False
+            for line in f:
+                if line[:4] == b'$$$$':
+                    # the separator is kept with its record, so that records can be written out as they are
+                    if hasContent:
+                        starts.append(start)
+                        ends.append(position + len(line))
+                    start = position + len(line)
+                    hasContent = False
+                elif line.strip():
+                    hasContent = True
+                position += len(line)
+            if hasContent:
+                starts.append(start)
+                ends.append(position)
+    return np.array(starts, dtype = np.int64), np.array(ends, dtype = np.int64)
+
+@lru_cache(maxsize = 16)
+def _cachedFrames(filepath, mtime, size):
+    return scanFrames(filepath)
+
+def frameIndex(filepath):
+    # Byte offsets of the frames of filepath (see scanFrames). The scan is repeated only if the file changed
+    status = os.stat(filepath)
+    return _cachedFrames(os.path.abspath(filepath), status.st_mtime_ns, status.st_size)
+
+def frameNumber(frameId):
+    # Index (from 0) of the frame in its file. Frame identifiers are "<file name>#<frame number from 1>"
+    return int(frameId.rpartition('#')[2]) - 1
+
+def isEnsemble(inpath):
+    # Conformers are read from a single multi-frame file if inpath is a file, and from one file per conformer if inpath is a directory
+    return os.path.isfile(inpath)
+
+def listConformers(inpath):
+    # Return the names of the conformers found at inpath: file names in a directory, or frame identifiers of a multi-frame file
+    if isEnsemble(inpath):
+        starts, ends = frameIndex(inpath)
+        name = os.path.basename(inpath)
+        return [name + '#' + str(k + 1) for k in range(len(starts))]
+    return [x for x in os.listdir(inpath) if x[-3:] in ['xyz', 'pdb', 'mol']]
+
+def iterFrameContents(filepath, frameIds):
+    # Yield the raw content (bytes) of each frame in frameIds, in the given order
+    starts, ends = frameIndex(filepath)
+    with open(filepath, 'rb') as f:
+        for frameId in frameIds:
+            k = frameNumber(frameId)
+            f.seek(starts[k])
+            yield f.read(ends[k] - starts[k])
+
+def iterCoordinates(fileList, inpath, hetatm = True, keepH = False, n_threads = None, batch_size = 64):
+    # Yield coordinates and elements of each conformer in fileList, in order. See loadCoordinates
+    if isEnsemble(inpath):
+        extension = inpath.split('.')[-1]
+        for content in iterFrameContents(inpath, fileList):
+            yield parseFrame(content, extension, hetatm, keepH)
+        return
+    # files are submitted in batches, so the cost of scheduling is small next to reading and parsing small files
+    batches = [fileList[i:i + batch_size] for i in range(0, len(fileList), batch_size)]
+    readBatch = lambda batch: [readCoordinates(inpath + theFile, hetatm, keepH) for theFile in batch]
+    if n_threads == 1 or len(batches) <= 1:
+        for batch in batches:
+            yield from readBatch(batch)
+    else:
+        with ThreadPoolExecutor(max_workers = n_threads) as executor:
+            for parsed in executor.map(readBatch, batches):
+                yield from parsed
+
+def xyzToArray(xyzFilePath, keepH = False):
+    # Read xyz coordinates into numpy array. Remove hydrogen atoms
+    return readCoordinates(xyzFilePath, keepH = keepH)[0]
+
+def pdbToArray(pdbfilePath, hetatm = True, keepH = False):
+    # Read pdb coordinates into numpy array. Remove hydrogen atoms
+    # hetatm: (Boolean) if True, read coordinates for ATOM and HETATM. If False, read only coordinates ATOM
+    return readCoordinates(pdbfilePath, hetatm, keepH)[0]
+
+def molToArray(molfilePath, keepH = False):
+    return readCoordinates(molfilePath, keepH = keepH)[0]
+
+def fileToArray(filepath, hetatm = True, keepH=False):
+    # Read xyz or pdb files into numpy arrays
+    return readCoordinates(filepath, hetatm, keepH)[0]
+
+def loadCoordinates(fileList, inpath, hetatm = True, keepH = False, n_threads = None, batch_size = 64):
+    # Read the coordinates of many conformers. File reads overlap in a pool of threads. Frames of a multi-frame file are
+    # streamed from the file and written directly into the coordinate array.
+    # inputs
+    # fileList: (list of string) list of file names, or frame identifiers if inpath is a multi-frame file. All conformers must have the same atoms in the same order
+    # inpath: (string) path to the directory of input files, or to a multi-frame file
+    # hetatm: (Boolean) if input files are pdb format, whether or not to read HETATM coordinates along with ATOM
+    # keepH: (Boolean) whether or not to read hydrogen atoms
+    # n_threads: (int) number of threads reading files. Default of concurrent.futures.ThreadPoolExecutor if None
+    # batch_size: (int) number of files read by a thread at a time
+    # output: contiguous (n_files, n_atoms, 3) numpy array of coordinates and (n_files, n_atoms) numpy array of elements
+    coords = np.empty([len(fileList), 0, 3])
+    elements = []
+    for i, (frameCoords, frameElements) in enumerate(iterCoordinates(fileList, inpath, hetatm, keepH, n_threads, batch_size)):
+        if i == 0:
+            coords = np.empty([len(fileList), len(frameCoords), 3])
+        elif len(frameCoords) != coords.shape[1]:
+            raise ValueError('Conformers do not have the same number of atoms: %d atoms read from %s, %d expected' %(len(frameCoords), fileList[i], coords.shape[1]))
+        coords[i] = frameCoords
+        elements.append(frameElements)
+    elements = np.array(elements, dtype = str).reshape(len(fileList), coords.shape[1])
+    return coords, elements
+
+def fileHashes(fileList, inpath):
+    # Return the SHA-1 digest of the content of each file (or frame). Used to validate cached matrices against edited files
+    if isEnsemble(inpath):
+        return [hashlib.sha1(content).hexdigest() for content in iterFrameContents(inpath, fileList)]
+    hashes = []
+    for theFile in fileList:
+        with open(inpath + theFile, 'rb') as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    return hashes
+
 def rbfKernel(r, epsilon = 1.0):
     return np.exp(-(epsilon*r)**2)
 
-def clusterStats(RMSDmatrix, communityAssignment, centers, fileList, cluster_names):
+def pairSpread(RMSDmatrix):
+    # Diameter and mean RMSD over the pairs of distinct conformers of a square RMSD matrix. Only the stored pairs of a sparse matrix
+    # are counted (its diagonal is not stored). The mean is nan without any pair
+    if issparse(RMSDmatrix):
+        numPairs = RMSDmatrix.nnz
+    else:
+        numPairs = RMSDmatrix.shape[0] * (RMSDmatrix.shape[0] - 1)
+    meanRMSD = RMSDmatrix.sum() / numPairs if numPairs > 0 else np.nan
+    return RMSDmatrix.max(), meanRMSD
+
+def clusterStats(RMSDmatrix, communityAssignment, centers, fileList, cluster_names, communityIndex = None):
     # Report on the speads in each community. Use RMSD matrix as a complete, weighted graph. 
     # inputs
-    # RMSDmatrix: (numpy.array) matrix of RMSD values between all conformers
+    # RMSDmatrix: (numpy.array) matrix of RMSD values between all conformers. If a scipy.sparse matrix is given (sparse AutoGraph),
+    # only the stored pairs (within the RMSD cutoff) are known: the diameter is their maximum, at most the cutoff, and the mean RMSD
+    # is averaged over them. Both equal the values of the full matrix when the cutoff is above all RMSD values
     # communityAssignment: (list of int) list specifying the assigned community to each conformer
     # centers: (list of string) file names of centers
     # fileList: (list of string) file names of all conformers
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignment if not given
     # refer to the definitions of radius and diameter in graphs (https://mathworld.wolfram.com/GraphEccentricity.html)
     # output: (pandas.DataFrame) DF containing radius, diameter, mean RMSD of each cluster.
-    
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignment, fileList)
+
     # get communities in the order of centroids
-    centerIndices = [fileList.index(x) for x in centers]
-    communities = [communityAssignment[x] for x in centerIndices]
+    centerIndices = communityIndex.indexOf(centers)
+    communities = communityIndex.communityOf(centers)
     
     sizes = []
     diameters = []
     meanRMSDs = []
 
     for C in communities:
-        C_members = [x for x in range(RMSDmatrix.shape[0]) if communityAssignment[x] == C]
-        num_members = len(C_members)
-        community_matrix = RMSDmatrix[C_members,:][:,C_members]
-        diameter = np.max(community_matrix)
+        C_members = communityIndex.members(C)
+        diameter, meanRMSD = pairSpread(RMSDmatrix[C_members,:][:,C_members])
         size = len(C_members)
-        meanRMSD = np.sum(community_matrix) / (size * (size - 1)) # 2 * (n + 1) * (n / 2) simplified
 
         sizes.append(size)
         diameters.append(diameter)
         meanRMSDs.append(meanRMSD)
 
-    diameter = np.max(RMSDmatrix)
+    diameter, meanRMSD = pairSpread(RMSDmatrix)
     size = len(communityAssignment)
-    meanRMSD = np.sum(RMSDmatrix) / (size * (size - 1))
 
     sizes.append(size)
     diameters.append(diameter)
     meanRMSDs.append(meanRMSD)
 
-    outDf = pd.DataFrame({'size': sizes, 'diameter': diameters, 'mean_RMSD': meanRMSDs}, index = cluster_names + ['global'])
+    diameter, meanRMSD = pairSpread(RMSDmatrix[centerIndices,:][:,centerIndices])
+    size = len(centerIndices)
 
-    center_matrix = RMSDmatrix[centerIndices,:][:,centerIndices]
-    diameter = np.max(center_matrix)
-    meanRMSD = np.mean(center_matrix)
-    size = len(center_matrix)
-    meanRMSD = np.sum(center_matrix) / (size * (size - 1))
+    sizes.append(size)
+    diameters.append(diameter)
+    meanRMSDs.append(meanRMSD)
 
-    centerRow = pd.DataFrame({'size': [size], 'diameter': [diameter], 'mean_RMSD': [meanRMSD]}, index = ['centers'])
-    outDf = outDf.append(centerRow)
+    outDf = pd.DataFrame({'size': sizes, 'diameter': diameters, 'mean_RMSD': meanRMSDs}, index = cluster_names + ['global', 'centers'])
 
     return outDf
 
@@ -185,33 +372,17 @@ def arrayToXyzFromMol(coordList, fileList, referenceFilePath, outpath):
         with open(outpath + fileList[i][:-3]+'xyz', 'w') as g:
             g.write(content)
 
-def save_outputs(inpath, outpath, fileList, communityAssignments, centralNodes, cluster_names):
-    centerIndices = [fileList.index(x) for x in centralNodes]
-    community_list = [communityAssignments[x] for x in centerIndices]
-    for i in range(len(community_list)):
-        clusterpath = outpath + cluster_names[i]
-        os.system('mkdir ' + clusterpath)
-        C_members = [x for x in range(len(fileList)) if communityAssignments[x] == community_list[i]]
-        for mem in C_members:
-            os.system('cp ' + inpath + fileList[mem] + ' ' + clusterpath)
-        
-    clusterpath = outpath + 'centers/'
-    os.system('mkdir ' + clusterpath)
-    for centroid in centralNodes:
-        os.system('cp ' + inpath + centroid + ' ' + clusterpath)
-
-def cluster_summary(outpath, fileList, communityAssignments, centralNodes, cluster_names):
+def cluster_summary(outpath, fileList, communityAssignments, centralNodes, cluster_names, communityIndex = None):
     # Save csv file in which the classification of each conformer is specified.
-    centerIndices = [fileList.index(x) for x in centralNodes]
-    community_list = [communityAssignments[x] for x in centerIndices]
-
-    outDf = pd.DataFrame()
-    for i in range(len(community_list)):
-        C_indices = [x for x in range(len(fileList)) if communityAssignments[x] == community_list[i]]
-        C_members = [fileList[x] for x in C_indices]
-        Cdf = pd.DataFrame(cluster_names[i], index = C_members, columns = ['cluster'])
-        outDf = outDf.append(Cdf, sort = False)
-        
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignments if not given
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignments, fileList)
+    community_list = communityIndex.communityOf(centralNodes)
+    C_members = [communityIndex.members(C) for C in community_list]
+    C_indices = np.concatenate(C_members + [np.zeros(0, dtype = int)])
+    names = np.repeat(np.array(cluster_names[:len(community_list)], dtype = object), [len(x) for x in C_members])
+    outDf = pd.DataFrame({'cluster': names}, index = [fileList[x] for x in C_indices])
+
     outDf['center'] = 0
     outDf.loc[centralNodes, 'center'] = 1
 
@@ -0,0 +1,98 @@
+# 2021-06-14
+
+# Kiyoto Aramis Tanemura
+
+# Binary storage of symmetric conformer matrices (RMSD, affinity). Only the upper triangle is saved, in the condensed
+# ordering of scipy.spatial.distance.squareform, as a .npy file. The file names corresponding to the axes are saved in a
+# .index sidecar with one name per line, optionally followed by a tab and the hash of the file content.
+# Matrices are opened memory mapped so that cached results are read almost instantly.
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import squareform
+from scipy.sparse import save_npz
+
+def condensedIndex(n, i, j):
+    # Position of element (i, j), i != j, of a symmetric n x n matrix in its condensed upper triangle. Accepts arrays
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    return n * lo - lo * (lo + 1) // 2 + hi - lo - 1
+
+def saveMatrix(path, matrix, fileList, dtype = 'float64', hashes = None):
+    # Save a symmetric matrix with zero diagonal as condensed upper triangle with its file name index
+    # inputs
+    # path: (string) path without extension. Writes path.npy and path.index
+    # matrix: (numpy array) square matrix, or its condensed upper triangle
+    # fileList: (list of string) file names corresponding to the axes of matrix
+    # dtype: (string) "float64" or "float32" for half the disk space
+    # hashes: (list of string) optional content hash of each file, to validate the cache when it is read again
+    if matrix.ndim == 2:
+        matrix = squareform(matrix, checks = False)
+    with open(path + '.npy', 'wb') as f:
+        np.save(f, np.asarray(matrix, dtype = dtype))
+    if hashes is not None:
+        lines = [x + '\t' + h for x, h in zip(fileList, hashes)]
+    else:
+        lines = list(fileList)
+    with open(path + '.index', 'w') as g:
+        g.write('\n'.join(lines) + '\n')
+
+def loadMatrix(path, mmap = True):
+    # Open a matrix saved by saveMatrix.
+    # output: condensed upper triangle (memory mapped if mmap), the list of file names, and the list of content hashes (None if not saved)
+    condensed = np.load(path + '.npy', mmap_mode = 'r' if mmap else None)
+    with open(path + '.index', 'r') as f:
+        lines = [x.split('\t') for x in f.read().splitlines()]
+    fileList = [x[0] for x in lines]
+    hashes = [x[1] for x in lines] if all(len(x) == 2 for x in lines) else None
+    return condensed, fileList, hashes
+
+def denseFromCondensed(condensed, storedList, fileList):
+    # Expand a condensed matrix into a dense float64 matrix with axes in the order of fileList.
+    # output: dense matrix, or None if any file in fileList is absent from storedList
+    position = {x: i for i, x in enumerate(storedList)}
+    if any(x not in position for x in fileList):
+        return None
+    if list(fileList) == list(storedList):
+        return squareform(np.asarray(condensed, dtype = float))
+    n = len(storedList)
+    indices = np.array([position[x] for x in fileList])
+    dense = np.zeros([len(fileList), len(fileList)])
+    for a in range(len(fileList)):
+        others = indices != indices[a]
+        dense[a, others] = condensed[condensedIndex(n, indices[a], indices[others])]
+    return dense
+
+def readMatrix(path, fileList):
+    # Read a cached matrix for the files in fileList, in that order. The binary store is preferred.
+    # A csv file (e.g. an RMSD matrix provided by the user) is read if no binary store is present.
+    # output: dense numpy array, or None if no cached matrix covers all files
+    if os.path.exists(path + '.npy') and os.path.exists(path + '.index'):
+        condensed, storedList, _ = loadMatrix(path)
+        return denseFromCondensed(condensed, storedList, fileList)
+    if os.path.exists(path + '.csv'):
+        df = pd.read_csv(path + '.csv', index_col = 0)
+        if any(x not in df.index for x in fileList):
+            return None
+        return df.reindex(index = fileList, columns = fileList).to_numpy()
+    return None
+
+def writeMatrix(path, matrix, fileList, dtype = 'float64', write_csv = False, hashes = None):
+    # Save matrix to the binary store. Optionally export the dense matrix as csv with file names for indices and columns
+    saveMatrix(path, matrix, fileList, dtype, hashes)
+    if write_csv:
+        exportCsv(path, matrix, fileList)
+
+def writeSparseMatrix(path, matrix, fileList, dtype = 'float64'):
+    # Save a scipy.sparse matrix as path.npz (see scipy.sparse.load_npz) with the path.index file name sidecar
+    save_npz(path + '.npz', matrix.tocsr().astype(dtype))
+    with open(path + '.index', 'w') as g:
+        g.write('\n'.join(fileList) + '\n')
+
+def exportCsv(path, matrix, fileList):
+    # Save the dense matrix as path.csv with file names for indices and columns
+    df = pd.DataFrame(matrix, index = fileList, columns = fileList)
+    with open(path + '.csv', 'w') as g:
+        df.to_csv(g)
+    del df
@@ -0,0 +1,39 @@
+# 2021-06-14
+
+# Kiyoto Aramis Tanemura
+
+# Helpers for process parallel stages. Large read-only arrays (coordinates, RMSD matrices) are placed in shared memory
+# so that worker processes attach to them by name instead of receiving pickled copies.
+
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+def numWorkers(n_jobs):
+    # Translate the n_jobs argument to a number of processes. n_jobs = -1 uses all available cores
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+def createSharedArray(array):
+    # Copy a numpy array into a new shared memory block
+    # output: shared memory handle, numpy view on the shared block, and the spec needed by workers to attach
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)
+    shared[...] = array
+    return shm, shared, (shm.name, array.shape, array.dtype.str)
+
+def attachSharedArray(spec):
+    # Attach to a shared memory block created by createSharedArray from a worker process
+    name, shape, dtype = spec
+    # Pool workers share the resource tracker of the parent, which unlinks the block in releaseSharedArray
+    shm = shared_memory.SharedMemory(name = name)
+    return shm, np.ndarray(shape, dtype = np.dtype(dtype), buffer = shm.buf)
+
+def releaseSharedArray(shm):
+    # Close and free a shared memory block owned by the calling process
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,41 @@
+# 2021-08-02
+
+# Kiyoto Aramis Tanemura
+
+# Cluster one filtered graph at several resolutions. The graph is converted to CSR once and sent once to each worker
+# process, which clusters it at the resolutions it receives. The aggregation levels of Louvain and Leiden are built from
+# the communities of the previous level, which depend on the resolution, so only the graph of the first level is shared.
+
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from .LouvainClustering import getModularitySparse
+from .parallel import numWorkers
+
+_worker = {}
+
+def _initSweepWorker(graph, method, Q_threshold, max_iter):
+    _worker['graph'] = graph
+    _worker['method'] = method
+    _worker['options'] = (Q_threshold, max_iter)
+
+def _sweepWorker(resolution):
+    graph = _worker['graph']
+    Q_threshold, max_iter = _worker['options']
+    assignment = _worker['method'](graph, Q_threshold = Q_threshold, max_iter = max_iter, resolution = resolution)
+    return getModularitySparse(graph, assignment, 1.0), getModularitySparse(graph, assignment, resolution), assignment
+
+def resolutionSweep(affinityMatrix, resolutions, method, n_jobs = 1, Q_threshold = 0.0, max_iter = 50):
+    # inputs
+    # affinityMatrix: (numpy array or scipy.sparse matrix) filtered affinity matrix
+    # resolutions: (list of float) resolutions of the modularity
+    # method: (function) community detection with the signature of Louvain
+    # n_jobs: (int) number of processes. -1 uses all cores. Results are identical to the serial mode
+    # output: list of (modularity, modularity at the resolution, community assignment) in the order of resolutions
+    graph = csr_matrix(affinityMatrix, dtype = float)
+    processes = min(numWorkers(n_jobs), len(resolutions))
+    if processes <= 1:
+        _initSweepWorker(graph, method, Q_threshold, max_iter)
+        return list(map(_sweepWorker, resolutions))
+    with Pool(processes, initializer = _initSweepWorker, initargs = (graph, method, Q_threshold, max_iter)) as pool:
+        # one resolution at a time, so that slow resolutions do not hold back a whole batch
+        return pool.map(_sweepWorker, resolutions, chunksize = 1)
@@ -4,9 +4,16 @@
 
 # supporting functions for clustering by RMSD.
 # I followed a numpy implementation of Kabsch algorithm to superimpose two coordinates (https://en.wikipedia.org/wiki/Kabsch_algorithm)
+# RMSD values without superposition are computed by the quaternion characteristic polynomial (QCP) method: Theobald, D. L. Acta Cryst. 2005, A61, 478. DOI: 10.1107/S0108767305015266
 
+import os
 import numpy as np
-from .functions import fileToArray
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from .functions import loadCoordinates, fileHashes
+from .matrixStore import loadMatrix, denseFromCondensed, readMatrix, writeMatrix, exportCsv
+from .conformerCache import cachedCoordinates, cachedRmsdCovers, readCachedRmsd, writeCachedRmsd
+from .parallel import numWorkers, createSharedArray, attachSharedArray, releaseSharedArray
 
 def getCentroid(coordMatrix):
     # return xyz coordinates of mean coordinate of provided coordinates
@@ -43,63 +50,364 @@ def superimpose(coord0, coord1, return_rot_matrix = False):
 
 def rmsd(coord0, coord1):
     # input coordinate matrix of two structures
-    coord0, coord1 = superimpose(coord0, coord1)
-    num_atoms = coord0.shape[0]
-    distances = []
-    for i in range(num_atoms):
-        distances.append(getDistance(coord0[i], coord1[i]))
-    distSq = [x ** 2 for x in distances]
-    return np.sqrt(np.mean(distSq))
-
-def rmsdMatrix(fileList, inpath, hetatm = True):
+    # The structures are not modified. Use superimpose(...) if the aligned coordinates are needed.
+    coords = stackCoords([coord0, coord1])
+    innerProds = innerProducts(coords)
+    return qcpRmsd(coords[0], innerProds[0], coords[1:], innerProds[1:])[0]
+
+def stackCoords(coords):
+    # Stack conformer coordinates into one contiguous (n_conformers, n_atoms, 3) array, each conformer centered at the origin.
+    # input: list of coordinate matrices with equal number of atoms
+    stacked = np.ascontiguousarray(np.array(coords, dtype = float))
+    stacked -= np.mean(stacked, axis = 1, keepdims = True)
+    return stacked
+
+def batchRmsd(coord0, coords):
+    # Batched Kabsch algorithm. Return RMSD values between one centered reference and a stack of centered conformers.
+    # Numerically equivalent to rmsd(coord0, coords[k]) for each k.
+    # inputs
+    # coord0: (numpy array) centered coordinates of the reference, shape (n_atoms, 3)
+    # coords: (numpy array) centered coordinates of the other conformers, shape (m, n_atoms, 3)
+    if coords.shape[0] == 0:
+        return np.zeros(0)
+    H = np.matmul(coords.transpose(0, 2, 1), coord0)
+    v, s, wt = np.linalg.svd(H)
+    is_reflection = (np.linalg.det(v) * np.linalg.det(wt)) < 0
+    v[is_reflection, :, -1] = -v[is_reflection, :, -1]
+    R = np.matmul(v, wt)
+    sqDev = np.sum((np.matmul(coords, R) - coord0) ** 2, axis = (1, 2))
+    return np.sqrt(sqDev / coord0.shape[0])
+
+def innerProducts(coords):
+    # Precompute the inner product (sum of squared coordinates) of each centered conformer. Input shape (n_conformers, n_atoms, 3)
+    return np.einsum('nij,nij->n', coords, coords)
+
+def qcpRmsd(coord0, G0, coords, Gs, precision = 1e-14, max_iter = 50):
+    # RMSD values between one centered reference and a stack of centered conformers after optimal superposition.
+    # The largest eigenvalue of the quaternion key matrix is found by Newton-Raphson on its characteristic polynomial,
+    # so neither the rotation matrix nor the rotated coordinates are built.
+    # inputs
+    # coord0: (numpy array) centered coordinates of the reference, shape (n_atoms, 3)
+    # G0: (float) inner product of the reference (see innerProducts)
+    # coords: (numpy array) centered coordinates of the other conformers, shape (m, n_atoms, 3)
+    # Gs: (numpy array) inner products of the other conformers, shape (m,)
+    if coords.shape[0] == 0:
+        return np.zeros(0)
+    M = np.matmul(coord0.T, coords)
+    Sxx, Sxy, Sxz = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    Syx, Syy, Syz = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    Szx, Szy, Szz = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+    Sxx2, Syy2, Szz2 = Sxx * Sxx, Syy * Syy, Szz * Szz
+    Sxy2, Syz2, Sxz2 = Sxy * Sxy, Syz * Syz, Sxz * Sxz
+    Syx2, Szy2, Szx2 = Syx * Syx, Szy * Szy, Szx * Szx
+    SyzSzymSyySzz2 = 2.0 * (Syz * Szy - Syy * Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+    SxzpSzx, SyzpSzy, SxypSyx = Sxz + Szx, Syz + Szy, Sxy + Syx
+    SyzmSzy, SxzmSzx, SxymSyx = Syz - Szy, Sxz - Szx, Sxy - Syx
+    SxxpSyy, SxxmSyy = Sxx + Syy, Sxx - Syy
+    # coefficients of the characteristic polynomial x^4 + C2 x^2 + C1 x + C0
+    C2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    C1 = 8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx - Sxx * Syy * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz)
+    C0 = Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2 \
+        + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2) \
+        + (-SxzpSzx * SyzmSzy + SxymSyx * (SxxmSyy - Szz)) * (-SxzmSzx * SyzpSzy + SxymSyx * (SxxmSyy + Szz)) \
+        + (-SxzpSzx * SyzpSzy - SxypSyx * (SxxpSyy - Szz)) * (-SxzmSzx * SyzmSzy - SxypSyx * (SxxpSyy + Szz)) \
+        + (SxypSyx * SyzpSzy + SxzpSzx * (SxxmSyy + Szz)) * (-SxymSyx * SyzmSzy + SxzpSzx * (SxxpSyy + Szz)) \
+        + (SxypSyx * SyzmSzy + SxzmSzx * (SxxmSyy - Szz)) * (-SxymSyx * SyzpSzy + SxzmSzx * (SxxpSyy - Szz))
+    E0 = (G0 + Gs) / 2.0
+    # Newton-Raphson from the upper bound E0. Each pair stops on its own, so values do not depend on the batch they were computed in
+    eigenvalue = E0.copy()
+    active = np.ones(len(E0), dtype = bool)
+    for _ in range(max_iter):
+        x = eigenvalue[active]
+        x2 = x * x
+        b = (x2 + C2[active]) * x
+        a = b + C1[active]
+        delta = (a * x + C0[active]) / (2.0 * x2 * x + b + a)
+        eigenvalue[active] = x - delta
+        active[active] = np.abs(delta) >= np.abs(precision * x)
+        if not active.any():
+            break
+    return np.sqrt(np.abs(2.0 * (E0 - eigenvalue) / coord0.shape[0]))
+
+def rmsdTiles(numFiles, tile_size = 256, numKnown = 0):
+    # Split the upper triangle of the RMSD matrix into square tiles of tile_size x tile_size pairs (half as many on the diagonal)
+    # numKnown: (int) the block between the first numKnown conformers is already known. Only tiles with columns beyond it are returned
+    # output: list of (row start, row end, column start, column end)
+    rowStarts = range(0, numFiles, tile_size)
+    colStarts = range(numKnown, numFiles, tile_size)
+    tiles = [(r, min(r + tile_size, numFiles), c, min(c + tile_size, numFiles)) for r in rowStarts for c in colStarts]
+    return [x for x in tiles if x[0] < x[3] - 1]
+
+def computeRmsdTile(coords, innerProds, rmsdMatrix, tile, kernel = 'qcp'):
+    # Fill the upper triangle entries of one tile of the RMSD matrix
+    # kernel: (string) "qcp" for the RMSD only quaternion kernel, "kabsch" for batched superposition by SVD
+    r0, r1, c0, c1 = tile
+    for i in range(r0, r1):
+        start = max(c0, i + 1)
+        if start < c1:
+            if kernel == 'kabsch':
+                rmsdMatrix[i, start:c1] = batchRmsd(coords[i], coords[start:c1])
+            else:
+                rmsdMatrix[i, start:c1] = qcpRmsd(coords[i], innerProds[i], coords[start:c1], innerProds[start:c1])
+
+_worker = {}
+
+def _initRmsdWorker(coordSpec, innerSpec, matrixSpec, kernel):
+    # Attach the shared coordinates and output matrix once per worker process
+    _worker['coords'] = attachSharedArray(coordSpec)
+    _worker['innerProds'] = attachSharedArray(innerSpec)
+    _worker['matrix'] = attachSharedArray(matrixSpec)
+    _worker['kernel'] = kernel
+
+def _rmsdTileWorker(tile):
+    computeRmsdTile(_worker['coords'][1], _worker['innerProds'][1], _worker['matrix'][1], tile, _worker['kernel'])
+    return tile
+
+def rmsdMatrix(fileList, inpath, hetatm = True, n_jobs = 1, tile_size = 256, kernel = 'qcp', known = None, cache_dir = None, hashes = None):
     # Return numpy array of atomic RMSD values between conformers of each file.
     # inputs
     # fileList: (list of string) list of file names considered
     # inpath: (string) path to the input files
     # hetatm: (Boolean) if input files are pdb format, whether or not to read HETATM coordinates along with ATOM
+    # n_jobs: (int) number of processes computing tiles of the matrix. -1 uses all cores. Results are identical to the serial mode
+    # tile_size: (int) number of rows and columns in each tile of the upper triangle
+    # kernel: (string) "qcp" (default) computes RMSD values without rotation matrices. "kabsch" superimposes each pair by SVD
+    # known: (numpy array) RMSD matrix already computed between the first files of fileList. Only pairs involving the other files are computed
+    # cache_dir: (string) if given, parsed coordinates are read from and saved to this cache directory (see conformerCache)
+    # hashes: (list of string) content hashes of fileList for the cache, computed if not given
     numFiles = len(fileList)
-    coords = [fileToArray(inpath + theFile, hetatm) for theFile in fileList]
+    numKnown = 0 if known is None else known.shape[0]
+    coords = stackCoords(cachedCoordinates(fileList, inpath, hetatm, cache_dir = cache_dir, hashes = hashes)[0])
+    innerProds = innerProducts(coords)
+    tiles = rmsdTiles(numFiles, tile_size, numKnown)
     rmsdMatrix = np.zeros([numFiles, numFiles])
-    for i in range(numFiles):
-        for j in range(i + 1, numFiles):
-            rmsdVal = rmsd(coords[i], coords[j])
-            rmsdMatrix[i, j] = rmsdVal
-            rmsdMatrix[j, i] = rmsdVal
+    if numKnown > 0:
+        rmsdMatrix[:numKnown, :numKnown] = np.triu(known, 1)
+    processes = min(numWorkers(n_jobs), len(tiles))
+    if processes <= 1:
+        for tile in tiles:
+            computeRmsdTile(coords, innerProds, rmsdMatrix, tile, kernel)
+    else:
+        coordShm, sharedCoords, coordSpec = createSharedArray(coords)
+        innerShm, sharedInner, innerSpec = createSharedArray(innerProds)
+        matrixShm, sharedMatrix, matrixSpec = createSharedArray(rmsdMatrix)
+        del coords, sharedCoords, sharedInner, rmsdMatrix
+        try:
+            with Pool(processes, initializer = _initRmsdWorker, initargs = (coordSpec, innerSpec, matrixSpec, kernel)) as pool:
+                for _ in pool.imap_unordered(_rmsdTileWorker, tiles):
+                    pass
+            rmsdMatrix = np.array(sharedMatrix)
+        finally:
+            del sharedMatrix
+            releaseSharedArray(coordShm)
+            releaseSharedArray(innerShm)
+            releaseSharedArray(matrixShm)
+    rmsdMatrix += rmsdMatrix.T
 
     return rmsdMatrix
 
-def assign_remaining_files(master_fileList, fileList, centroids, communityAssignment, inpath):
-    # Function for clustering with subset. Once clustering is finished on subset of files,                                                                                                                 
-    # then assign remaining files to clusters by their proximity to centroids.                                                                                                                             
-    # inputs                                                                                                                                                                                               
-    # master_fileList: (list of string) list of all file names                                                                                                                                             
-    # fileList: (list of string) list of file names sampled from master_fileList                                                                                                                           
-    # centroids: (list of string) list of file names selected as community centroids                                                                                                                       
-    # communityAssignment: (list of int) list of assinged community corresponding to fileList by index                                                                                                     
-    # output: master community assignment. Similar to communityAssignment, but corresponding to index of master_fileList                                                                                   
+def cachedRmsdMatrix(fileList, inpath, cachePath, hetatm = True, n_jobs = 1, dtype = 'float64', write_csv = False, cache_dir = None, kernel = 'qcp'):
+    # Return the RMSD matrix for fileList, reusing the matrix cached at cachePath (see matrixStore).
+    # Cached entries are keyed on file content. Files that were removed or edited are dropped from the cache,
+    # and only the pairs involving new (or edited) files are computed. The updated matrix is saved back to cachePath.
+    # If no binary cache is present, a csv matrix at cachePath (e.g. provided by the user) covering all files is used as is.
+    # cache_dir: (string) directory of the content addressed cache shared between output directories and clustering methods
+    # (see conformerCache). Consulted when cachePath does not cover all files, and filled with the matrix unless it already
+    # holds all pairs. None disables it
+    # kernel: (string) RMSD kernel of rmsdMatrix
+    hashes = fileHashes(fileList, inpath)
+    current = dict(zip(fileList, hashes))
+    knownFiles = []
+    known = None
+    if os.path.exists(cachePath + '.npy') and os.path.exists(cachePath + '.index'):
+        condensed, storedList, storedHashes = loadMatrix(cachePath)
+        if storedHashes is not None:
+            knownFiles = [x for x, h in zip(storedList, storedHashes) if current.get(x) == h]
+        if len(knownFiles) == len(fileList):
+            matrix = denseFromCondensed(condensed, storedList, fileList)
+        elif len(knownFiles) > 0:
+            known = denseFromCondensed(condensed, storedList, knownFiles)
+        unchanged = len(knownFiles) == len(storedList)
+        del condensed
+    else:
+        matrix = readMatrix(cachePath, fileList)
+        if matrix is not None:
+            return matrix
+        unchanged = False
 
-    centroid_coords = [fileToArray(inpath + theFile) for theFile in centroids]
-    num_centroids = len(centroids)
-    centroid_communities = [communityAssignment[fileList.index(x)] for x in centroids]
+    computed = False
+    shared = False
+    if len(knownFiles) < len(fileList) and cache_dir is not None:
+        sharedFiles, sharedKnown = readCachedRmsd(cache_dir, fileList, hashes, hetatm, kernel = kernel)
+        if len(sharedFiles) == len(fileList):
+            knownFiles, matrix = sharedFiles, sharedKnown
+            unchanged = False
+            shared = True
+        elif len(sharedFiles) > len(knownFiles):
+            knownFiles, known = sharedFiles, sharedKnown
+    if len(knownFiles) < len(fileList):
+        knownSet = set(knownFiles)
+        order = knownFiles + [x for x in fileList if x not in knownSet]
+        matrix = rmsdMatrix(order, inpath, hetatm, n_jobs, kernel = kernel, known = known, cache_dir = cache_dir, hashes = [current[x] for x in order])
+        if order != list(fileList):
+            position = {x: i for i, x in enumerate(order)}
+            indices = [position[x] for x in fileList]
+            matrix = matrix[indices, :][:, indices]
+        unchanged = False
+        computed = True
+    if cache_dir is not None and not shared and (computed or not cachedRmsdCovers(cache_dir, hashes, hetatm, kernel = kernel)):
+        writeCachedRmsd(cache_dir, matrix, hashes, hetatm, kernel = kernel)
+    if not unchanged:
+        writeMatrix(cachePath, matrix, fileList, dtype, write_csv, hashes)
+    elif write_csv:
+        exportCsv(cachePath, matrix, fileList)
+    return matrix
 
-    # remove already sampled files from yet to be assigned files.                                                                                                                                         
-    remainder_indices = [x for x in range(len(master_fileList)) if master_fileList[x] not in fileList]
-    remainder_coords = [fileToArray(inpath + master_fileList[x]) for x in remainder_indices]
+def selectPivots(coords, innerProds, num_pivots):
+    # Choose pivot conformers by farthest point (maxmin) selection starting from the first conformer.
+    # output: list of pivot indices and the (num_pivots, n_conformers) array of exact RMSD values from each pivot
+    numConformers = coords.shape[0]
+    num_pivots = min(num_pivots, numConformers)
+    pivots = [0]
+    pivotDistances = np.zeros([num_pivots, numConformers])
+    minDistance = np.full(numConformers, np.inf)
+    for k in range(num_pivots):
+        p = pivots[-1]
+        pivotDistances[k] = qcpRmsd(coords[p], innerProds[p], coords, innerProds)
+        pivotDistances[k, p] = 0.0
+        minDistance = np.minimum(minDistance, pivotDistances[k])
+        if k < num_pivots - 1:
+            pivots.append(int(np.argmax(minDistance)))
+    return pivots, pivotDistances
 
-    master_communityAssignment = [-1 for x in range(len(master_fileList))]
+def rmsdNeighbors(fileList, inpath, cutoff, hetatm = True, num_pivots = 16, tolerance = 1e-6, cache_dir = None):
+    # Return the RMSD values of all pairs of conformers within cutoff, without computing most of the pairs beyond it.
+    # RMSD after optimal superposition is a metric. For any pivot p, |d(a, p) - d(b, p)| is a lower bound of d(a, b),
+    # so pairs whose bound exceeds the cutoff are pruned before the QCP step.
+    # inputs
+    # fileList: (list of string) list of file names considered
+    # inpath: (string) path to the input files
+    # cutoff: (float) maximum RMSD of the pairs kept
+    # hetatm: (Boolean) if input files are pdb format, whether or not to read HETATM coordinates along with ATOM
+    # num_pivots: (int) number of pivot conformers, chosen by farthest point selection
+    # tolerance: (float) slack added to the cutoff when pruning, to absorb rounding of the pivot distances
+    # cache_dir: (string) if given, parsed coordinates are read from and saved to this cache directory (see conformerCache)
+    # output: (scipy.sparse.csr_matrix) symmetric matrix of RMSD values for pairs within cutoff. Every kept pair is stored explicitly,
+    # including pairs of identical conformers with RMSD 0. (int) number of pairs pruned by the bound
+    numFiles = len(fileList)
+    coords = stackCoords(cachedCoordinates(fileList, inpath, hetatm, cache_dir = cache_dir)[0])
+    innerProds = innerProducts(coords)
+    pivots, pivotDistances = selectPivots(coords, innerProds, num_pivots)
+    pivotRow = {p: k for k, p in enumerate(pivots)}
+    rows, cols, vals = [], [], []
+    numPruned = 0
+    for i in range(numFiles - 1):
+        if i in pivotRow:
+            candidates = np.arange(i + 1, numFiles)
+            rmsdVals = pivotDistances[pivotRow[i], i + 1:]
+        else:
+            lowerBound = np.zeros(numFiles - i - 1)
+            for k in range(len(pivots)):
+                np.maximum(lowerBound, np.abs(pivotDistances[k, i + 1:] - pivotDistances[k, i]), out = lowerBound)
+            candidates = np.flatnonzero(lowerBound <= cutoff + tolerance) + i + 1
+            numPruned += numFiles - i - 1 - len(candidates)
+            rmsdVals = qcpRmsd(coords[i], innerProds[i], coords[candidates], innerProds[candidates])
+        keep = rmsdVals <= cutoff
+        rows.append(np.full(np.count_nonzero(keep), i))
+        cols.append(candidates[keep])
+        vals.append(rmsdVals[keep])
+    rows = np.concatenate(rows + [np.zeros(0, dtype = int)])
+    cols = np.concatenate(cols + [np.zeros(0, dtype = int)])
+    vals = np.concatenate(vals + [np.zeros(0)])
+    graph = csr_matrix((np.concatenate([vals, vals]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))), shape = (numFiles, numFiles))
+    return graph, numPruned
 
-    # Fill master_communityAssignment first with already assigned conformers.                                                                                                                             
+def scoreChunk(names, inpath, centroid_coords, centroid_innerProds, hetatm = True):
+    # Read one chunk of conformers and compute their RMSD to every centroid.
+    # output: (len(names), num_centroids) numpy array of RMSD values
+    coords = stackCoords(loadCoordinates(names, inpath, hetatm)[0])
+    innerProds = innerProducts(coords)
+    rmsdVals = np.zeros([len(names), len(centroid_coords)])
+    for k in range(len(centroid_coords)):
+        rmsdVals[:, k] = qcpRmsd(centroid_coords[k], centroid_innerProds[k], coords, innerProds)
+    return rmsdVals
+
+def _initAssignWorker(inpath, centroid_coords, centroid_innerProds, hetatm):
+    # The centroid coordinates are small, so each worker receives its own copy once
+    _worker['inpath'] = inpath
+    _worker['centroid_coords'] = centroid_coords
+    _worker['centroid_innerProds'] = centroid_innerProds
+    _worker['hetatm'] = hetatm
+
+def _assignChunkWorker(names):
+    return names, scoreChunk(names, _worker['inpath'], _worker['centroid_coords'], _worker['centroid_innerProds'], _worker['hetatm'])
+
+def assign_remaining_files(master_fileList, fileList, centroids, communityAssignment, inpath, hetatm = True, n_jobs = 1, chunk_size = 1024, distancePath = None, cluster_names = None):
+    # Function for clustering with subset. Once clustering is finished on subset of files,
+    # then assign remaining files to clusters by their proximity to centroids.
+    # Remaining files are read and scored in chunks of chunk_size, so memory does not grow with the size of master_fileList.
+    # inputs
+    # master_fileList: (list of string) list of all file names
+    # fileList: (list of string) list of file names sampled from master_fileList
+    # centroids: (list of string) list of file names selected as community centroids
+    # communityAssignment: (list of int) list of assinged community corresponding to fileList by index
+    # inpath: (string) path to the input files
+    # hetatm: (Boolean) if input files are pdb format, whether or not to read HETATM coordinates along with ATOM
+    # n_jobs: (int) number of processes reading and scoring chunks. -1 uses all cores. Results are identical to the serial mode
+    # chunk_size: (int) number of remaining files read and scored at once
+    # distancePath: (string) if given, the RMSD of each remaining file to its nearest and second nearest centroid is written to this csv file
+    # cluster_names: (list of string) names of the clusters corresponding to centroids, used in the csv file. Centroid file names by default
+    # output: master community assignment. Similar to communityAssignment, but corresponding to index of master_fileList
+
+    centroid_coords = stackCoords(loadCoordinates(centroids, inpath, hetatm)[0])
+    centroid_innerProds = innerProducts(centroid_coords)
+    sample_position = {x: i for i, x in enumerate(fileList)}
+    centroid_communities = np.array([communityAssignment[sample_position[x]] for x in centroids])
+    if cluster_names is None:
+        cluster_names = list(centroids)
+
+    # Fill master_communityAssignment first with already assigned conformers.
+    master_communityAssignment = [-1 for x in range(len(master_fileList))]
+    master_position = {x: i for i, x in enumerate(master_fileList)}
     for i in range(len(fileList)):
-        sample_index = master_fileList.index(fileList[i])
-        master_communityAssignment[sample_index] = communityAssignment[i]
-
-    # Now assign the remainders.                                                                                                                                                                          
-    for i in range(len(remainder_indices)):
-        # get rmsd values of each remainder against all centroids                                                                                                                                         
-        rmsdVals = [rmsd(remainder_coords[i], centroid_coords[j]) for j in range(num_centroids)]
-        # find centroid corresponding to lowest RMSD                                                                                                                                                      
-        minVal = np.min(rmsdVals)
-        minIndex = rmsdVals.index(minVal)
-        master_communityAssignment[remainder_indices[i]] = centroid_communities[minIndex]
+        master_communityAssignment[master_position[fileList[i]]] = communityAssignment[i]
+
+    # remove already sampled files from yet to be assigned files.
+    remainder = [x for x in master_fileList if x not in sample_position]
+    chunks = [remainder[i:i + chunk_size] for i in range(0, len(remainder), chunk_size)]
+
+    # Now assign the remainders, chunk by chunk, to the centroid with the lowest RMSD.
+    processes = min(numWorkers(n_jobs), len(chunks))
+    pool = None
+    if processes <= 1:
+        _initAssignWorker(inpath, centroid_coords, centroid_innerProds, hetatm)
+        results = map(_assignChunkWorker, chunks)
+    else:
+        pool = Pool(processes, initializer = _initAssignWorker, initargs = (inpath, centroid_coords, centroid_innerProds, hetatm))
+        results = pool.imap(_assignChunkWorker, chunks)
+    g = open(distancePath, 'w') if distancePath is not None else None
+    try:
+        if g is not None:
+            g.write('file,cluster,rmsd,second_cluster,second_rmsd\n')
+        for names, rmsdVals in results:
+            order = np.argsort(rmsdVals, axis = 1, kind = 'stable')
+            for r in range(len(names)):
+                nearest = order[r, 0]
+                master_communityAssignment[master_position[names[r]]] = int(centroid_communities[nearest])
+                if g is None:
+                    continue
+                if rmsdVals.shape[1] > 1:
+                    second = order[r, 1]
+                    g.write('%s,%s,%.6f,%s,%.6f\n' %(names[r], cluster_names[nearest], rmsdVals[r, nearest], cluster_names[second], rmsdVals[r, second]))
+                else:
+                    g.write('%s,%s,%.6f,,\n' %(names[r], cluster_names[nearest], rmsdVals[r, nearest]))
+    finally:
+        if g is not None:
+            g.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     return master_communityAssignment
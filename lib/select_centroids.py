@@ -4,28 +4,95 @@
 
 # After assigning conformers to communities, choose centroid based on various criteria
 
+import heapq
 import numpy as np
 import pandas as pd
+from multiprocessing import Pool
+from scipy.sparse import issparse, csr_matrix
+from scipy.sparse.csgraph import dijkstra, connected_components
+from .communityIndex import CommunityIndex
+from .parallel import numWorkers, createSharedArray, attachSharedArray, releaseSharedArray
 
-def centroid_weighted_degree(fileList, communityAssignment, affinityMatrix):
+# Communities are independent, so the centroid of each is selected by a task of a process pool. Dense matrices are placed
+# in shared memory and sparse matrices are sent once to each worker. Tasks only carry the members of a community, whose
+# submatrix is extracted once in the worker. The largest communities are sent first, so that a giant community does not
+# start last while the small ones are spread over the other workers.
+
+_worker = {}
+
+def communitySubmatrix(matrix, C_members):
+    # Rows and columns of the members of a community, extracted in one step for numpy arrays
+    if issparse(matrix):
+        return matrix[C_members, :][:, C_members]
+    return matrix[np.ix_(C_members, C_members)]
+
+def _initCentroidWorker(matrix, spec, extract, select, options):
+    if spec is not None:
+        _worker['shm'], matrix = attachSharedArray(spec)
+    _worker['matrix'] = matrix
+    _worker['extract'] = extract
+    _worker['select'] = select
+    _worker['options'] = options
+
+def _centroidWorker(task):
+    k, C_members = task
+    return k, _worker['select'](_worker['extract'](_worker['matrix'], C_members), **_worker['options'])
+
+def selectPerCommunity(matrix, communityIndex, select, options = {}, extract = communitySubmatrix, n_jobs = 1):
+    # Apply select to the submatrix of each community
+    # inputs
+    # matrix: (numpy array or scipy.sparse matrix) matrix between all conformers
+    # communityIndex: (CommunityIndex) members of each community
+    # select: (function) module level function of the submatrix and options, returning the index of the centroid among the members
+    # extract: (function) submatrix of the members of a community, communitySubmatrix or communityGraph
+    # n_jobs: (int) number of processes. -1 uses all cores. Results are identical to the serial mode
+    # output: (list) result of select for each community, in the order of communityIndex.communities
+    communities = communityIndex.communities
+    # largest communities first, in the order of communities among equal sizes
+    tasks = [(k, communityIndex.members(communities[k])) for k in np.argsort(-np.asarray(communityIndex.sizes), kind = 'stable')]
+    results = [None] * len(communities)
+    processes = min(numWorkers(n_jobs), len(tasks))
+    if processes <= 1:
+        _initCentroidWorker(matrix, None, extract, select, options)
+        for k, result in map(_centroidWorker, tasks):
+            results[k] = result
+        _worker.clear()
+        return results
+    shm = spec = None
+    if not issparse(matrix):
+        shm, shared, spec = createSharedArray(matrix)
+        del shared
+        matrix = None
+    try:
+        with Pool(processes, initializer = _initCentroidWorker, initargs = (matrix, spec, extract, select, options)) as pool:
+            for k, result in pool.imap_unordered(_centroidWorker, tasks, chunksize = 1):
+                results[k] = result
+    finally:
+        if shm is not None:
+            releaseSharedArray(shm)
+    return results
+
+def degreeCentroid(community_subgraph):
+    # Index of the member of maximum weighted degree, the first among ties
+    return int(np.argmax(np.asarray(community_subgraph.sum(axis = 1)).ravel()))
+
+def medoidCentroid(community_subgraph):
+    # Index of the member of minimum sum of distances to the other members, the first among ties
+    return int(np.argmin(np.asarray(community_subgraph.sum(axis = 1)).ravel()))
+
+def centroid_weighted_degree(fileList, communityAssignment, affinityMatrix, communityIndex = None, n_jobs = 1):
     # Provided with list of conformers assigned to communities, choose representative centroid by conformers of maximum in community weighted degree
     # inputs
     # fileList: (list) names of xyz files for each conformer
     # communityAssignment: (list) list of community assignment correspoinding to the index of fileList
-    # affinityMatrix: {np.array) affinity matrix for each pairwise conformer similarity
-    numFiles = len(fileList)
-    communityList = list(set(communityAssignment))
-    centralNodes = []
-    comm_size = []
-    for C in communityList:                                                                                                                                                                           
-        C_members = [x for x in range(numFiles) if communityAssignment[x] == C]
-        C_member_files = [fileList[x] for x in C_members]
-        comm_size.append(len(C_members))
-        community_subgraph = affinityMatrix[C_members, :][:, C_members]                                                                                                                               
-        weightedDegrees = np.sum(community_subgraph, axis = 1).ravel().tolist()                                                                                                                       
-        max_wdegree = np.max(weightedDegrees)                                                                                                                                                         
-        max_index = weightedDegrees.index(max_wdegree) 
-        centralNodes.append(C_member_files[max_index])
+    # affinityMatrix: {np.array or scipy.sparse matrix) affinity matrix for each pairwise conformer similarity
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignment if not given
+    # n_jobs: (int) number of processes selecting the centroids of different communities. -1 uses all cores
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignment, fileList)
+    max_indices = selectPerCommunity(affinityMatrix, communityIndex, degreeCentroid, n_jobs = n_jobs)
+    centralNodes = [communityIndex.memberFiles(C)[i] for C, i in zip(communityIndex.communities, max_indices)]
+    comm_size = list(communityIndex.sizes)
 
     # Sort centers by size of clusters in descending order
     centralDf = pd.DataFrame({'size': comm_size}, index = centralNodes)
@@ -43,12 +110,8 @@ def centroid_energy(fileList, communityAssignment, Epath, E_label = 'energy'):
     E_data = pd.read_csv(Epath, index_col = 0)
     comm_df = pd.DataFrame({'cluster': communityAssignment}, index = fileList)
     comm_df = comm_df.join(E_data, how = 'inner', sort = True) # inner join to avoid missing energy values
-    communityList = list(set(communityAssignment))
-    centralNodes = []
-    for C in communityList:
-        sub_df = comm_df[comm_df['cluster'] == C]
-        min_val = sub_df[E_label].min()
-        centralNodes.append(sub_df.loc[sub_df[E_label] == min_val].index[0])
+    # first conformer of lowest energy in each community, communities in ascending order
+    centralNodes = list(comm_df.groupby('cluster', sort = True)[E_label].idxmin())
 
     # Sort centers by energy in ascending order
     centralDf = comm_df.loc[centralNodes]
@@ -56,25 +119,20 @@ def centroid_energy(fileList, communityAssignment, Epath, E_label = 'energy'):
 
     return list(centralDf.index)
 
-def centroid_medoid(fileList, communityAssignment, rmsdMatrix):
+def centroid_medoid(fileList, communityAssignment, rmsdMatrix, communityIndex = None, n_jobs = 1):
     # Choose centroids for each cluster by their medoid. 
     # inputs
     # fileList: (list) names of xyz or pdb files for each conformer
     # communityAssignment: (list) list of community assignment correspoinding to the index of fileList
     # rmsdMatrix: (numpy array) Matrix containing pairwise atomic RMSD between all conformers
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignment if not given
+    # n_jobs: (int) number of processes selecting the centroids of different communities. -1 uses all cores
 
-    numFiles = len(fileList)
-    communityList = list(set(communityAssignment))
-    centralNodes = []
-    comm_size = []
-    for C in communityList:
-        C_members = [x for x in range(numFiles) if communityAssignment[x] == C]
-        C_member_files = [fileList[x] for x in C_members]
-        comm_size.append(len(C_members))
-        community_subgraph = rmsdMatrix[C_members, :][:, C_members]
-        dist_sum = np.sum(community_subgraph, axis = 1)
-        min_index = np.argmin(dist_sum)
-        centralNodes.append(C_member_files[min_index])
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignment, fileList)
+    min_indices = selectPerCommunity(rmsdMatrix, communityIndex, medoidCentroid, n_jobs = n_jobs)
+    centralNodes = [communityIndex.memberFiles(C)[i] for C, i in zip(communityIndex.communities, min_indices)]
+    comm_size = list(communityIndex.sizes)
 
     # Sort centers by size of clusters in descending order
     centralDf = pd.DataFrame({'size': comm_size}, index = centralNodes)
@@ -85,85 +143,280 @@ def centroid_medoid(fileList, communityAssignment, rmsdMatrix):
 
 # added 2020-09-08 by KAT. My suspicion is that the selection by weighted degree is unsuitable for MD frames. 
 # Will select centroids by the lowest in-cluster eccentricity. Eccentricity can be calculatd using Dijkstra's shortest path algorithm.
+# Shortest paths are computed with scipy.sparse.csgraph on the subgraph of each community. Betweenness is accumulated by
+# Brandes' algorithm (Brandes, U. J. Math. Sociol. 2001, 25, 163. DOI: 10.1080/0022250X.2001.9990249).
+
+def communityGraph(filtered_rmsd_matrix, C_members):
+    # Subgraph of the members of a community as a CSR matrix without self loops. Zero entries are not edges
+    community_subgraph = csr_matrix(communitySubmatrix(filtered_rmsd_matrix, C_members), dtype = float)
+    community_subgraph.setdiag(0)
+    community_subgraph.eliminate_zeros()
+    return community_subgraph
+
+def shortestPaths(graph, sources):
+    # Shortest path lengths from each source to all nodes (np.inf if unreachable). Breadth first search if all edges have
+    # unit weight (e.g. the boolean filtered graph), else Dijkstra's algorithm with a binary heap
+    return dijkstra(graph, directed = False, indices = sources, unweighted = bool(np.all(graph.data == 1)))
 
-def diekstra(filtered_rmsd_matrix_community, i):
-    '''Use Dijkstra's algorithm to find shortest path from index i to all other nodes'''
-    # initialize lists
-    visited = []
-    unvisited = [x for x in range(filtered_rmsd_matrix_community.shape[0])]
-    record = [np.inf for x in range(filtered_rmsd_matrix_community.shape[0])]#{x: np.inf for x in range(graph.shape[0])}
-    record[i] = 0
-    lastNode = [-1 for x in record]
-    # repeat until all nodes have been visited
-    while len(unvisited) > 0:
-        visit_index = unvisited[np.argmin([record[x] for x in unvisited])]
-        unvisited_neighbors = [x for x in unvisited if filtered_rmsd_matrix_community[visit_index, x] > 0]
-        # Calculate distance to unvisited neighbor. If value is shorter than recorded, update distance.
-        updateDist = filtered_rmsd_matrix_community[visit_index, :] + record[visit_index]
-        for j in unvisited_neighbors:
-            record[j] = np.min([updateDist[j], record[j]])
-            if updateDist[j] < record[j]:
-                lastNode[j] = visit_index
-        # update visited/unvisited node list
-        unvisited.remove(visit_index)
-        visited.append(visit_index)
-    return record, lastNode
-
-def centroid_eccentricity(fileList, communityAssignment, filtered_rmsd_matrix):
+def eccentricities(graph, batch_size = None):
+    # Eccentricity of every node, from shortest paths computed for batches of sources so that memory stays O(batch_size * n)
+    numNodes = graph.shape[0]
+    if batch_size is None:
+        batch_size = max(1, (1 << 24) // max(numNodes, 1))
+    ecc = np.empty(numNodes)
+    for start in range(0, numNodes, batch_size):
+        sources = np.arange(start, min(start + batch_size, numNodes))
+        ecc[sources] = shortestPaths(graph, sources).max(axis = 1)
+    return ecc
+
+def minimumEccentricityNode(graph, bounding = True, max_searches = None):
+    # Index of the node of minimum eccentricity, the lowest index among ties, and a bound on how much its eccentricity
+    # may exceed the minimum (0 when exact).
+    # If bounding, use the bounding eccentricities algorithm (Takes, F. W.; Kosters, W. A. Algorithms 2013, 6, 100.
+    # DOI: 10.3390/a6010100): each search from a node v of eccentricity e bounds the eccentricity of every node w by
+    # max(d(v, w), e - d(v, w)) <= ecc(w) <= e + d(v, w). Nodes that cannot be the lowest index node of minimum
+    # eccentricity are dropped, and the search continues from the remaining nodes until all bounds are tight.
+    # max_searches: (int) if given, stop after max_searches searches (implies bounding). The node of smallest upper bound is
+    #   returned, and the error is its upper bound minus the smallest lower bound of the nodes not yet dropped
+    numNodes = graph.shape[0]
+    if numNodes == 1:
+        return 0, 0.0
+    if connected_components(graph, directed = False)[0] > 1:
+        # every eccentricity is infinite
+        return 0, 0.0
+    if not bounding and max_searches is None:
+        return int(np.argmin(eccentricities(graph))), 0.0
+    weighted = not np.all(graph.data == 1)
+    lower = np.zeros(numNodes)
+    upper = np.full(numNodes, np.inf)
+    candidate = np.ones(numNodes, dtype = bool)
+    tolerance = 0.0
+    best, bestNode = np.inf, numNodes
+    degrees = np.diff(graph.indptr)
+    v = int(np.argmax(degrees))
+    step = 0
+    searches = 0
+    while True:
+        d = shortestPaths(graph, v)
+        searches += 1
+        e = d.max()
+        if weighted:
+            tolerance = 1e-9 * e
+        lower = np.maximum(lower, np.maximum(d, e - d))
+        upper = np.minimum(upper, e + d)
+        lower[v] = upper[v] = e
+        # exact eccentricities known so far
+        known = upper - lower <= tolerance
+        if upper[known].min() < best - tolerance:
+            best = upper[known].min()
+            bestNode = numNodes
+        bestNode = min(bestNode, int(np.flatnonzero(known & (upper <= best + tolerance))[0]))
+        # drop nodes whose eccentricity is known, and nodes that can at best tie with bestNode from a higher index
+        candidate &= ~known
+        candidate &= ~(lower > best + tolerance)
+        candidate[bestNode:] &= ~(lower[bestNode:] >= best - tolerance)
+        remaining = np.flatnonzero(candidate)
+        if len(remaining) == 0:
+            return bestNode, 0.0
+        if max_searches is not None and searches >= max_searches:
+            open_nodes = remaining if bestNode == numNodes else np.append(remaining, bestNode)
+            chosen = int(open_nodes[np.argmin(upper[open_nodes])])
+            if chosen != bestNode and bestNode < numNodes and upper[chosen] >= best:
+                chosen = bestNode
+            return chosen, float(upper[chosen] - min(best, lower[remaining].min()))
+        # alternate between the node of smallest lower bound and of largest upper bound (lowest index among ties)
+        step += 1
+        if step % 2 == 1:
+            v = int(remaining[np.argmin(lower[remaining])])
+        else:
+            v = int(remaining[np.argmax(upper[remaining])])
+
+def eccentricityCentroid(community_subgraph, bounding = True, pivots = None, cutoff = None):
+    # Index of the member of minimum eccentricity and the error bound of its eccentricity, see centroid_eccentricity
+    max_searches = pivots if approximated(community_subgraph.shape[0], pivots, cutoff) else None
+    return minimumEccentricityNode(community_subgraph, bounding, max_searches)
+
+def centroid_eccentricity(fileList, communityAssignment, filtered_rmsd_matrix, communityIndex = None, bounding = True, pivots = None, cutoff = None, return_error = False, n_jobs = 1):
     # Provided with list of conformers assigned to communities, choose representative centroid by conformers of minimum in community eccentricity                                                      
     # inputs                                                                                                                                                                                               
     # fileList: (list) names of xyz files for each conformer                                                                                                                                               
     # communityAssignment: (list) list of community assignment correspoinding to the index of fileList                                                                                                     
-    # filtered_rmsd_matrix: {np.array) RMSD matrix between conformers, except assigning distances above threshold to zero   
-    numFiles = len(fileList)
-    communityList = list(set(communityAssignment))
-    centralNodes = []
-    comm_size = []
-    for C in communityList:
-        C_members = [x for x in range(numFiles) if communityAssignment[x] == C]
-        C_member_files = [fileList[x] for x in C_members]
-        comm_size.append(len(C_members))
-        community_subgraph = filtered_rmsd_matrix[C_members, :][:, C_members]
-        community_eccentricities = []
-        for i in range(len(C_member_files)):
-            community_eccentricities.append(np.max(diekstra(community_subgraph, i)[0]))
-        min_eccentricity_index = np.argmin(community_eccentricities)
-        centralNodes.append(C_member_files[min_eccentricity_index])
+    # filtered_rmsd_matrix: {np.array or scipy.sparse matrix) RMSD matrix between conformers, except assigning distances above threshold to zero   
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignment if not given
+    # bounding: (Boolean) bound eccentricities to search from few members (exact). If False, search from every member
+    # pivots: (int) if given, stop the bounding searches after pivots searches in communities of more than cutoff members
+    # cutoff: (int) number of members above which pivots applies. None applies it to all communities
+    # return_error: (Boolean) also return a dict of the error bound of the eccentricity of each centroid (0 when exact)
+    # n_jobs: (int) number of processes selecting the centroids of different communities. -1 uses all cores
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignment, fileList)
+    options = {'bounding': bounding, 'pivots': pivots, 'cutoff': cutoff}
+    results = selectPerCommunity(filtered_rmsd_matrix, communityIndex, eccentricityCentroid, options, communityGraph, n_jobs)
+    centralNodes = [communityIndex.memberFiles(C)[i] for C, (i, error) in zip(communityIndex.communities, results)]
+    comm_size = list(communityIndex.sizes)
+    errors = [error for i, error in results]
 
     # Sort centers by size of clusters in descending order                                                                                                                                                
-    centralDf = pd.DataFrame({'size': comm_size}, index = centralNodes)
+    centralDf = pd.DataFrame({'size': comm_size, 'error': errors}, index = centralNodes)
     centralDf.sort_values(by = 'size', ascending = False, inplace = True)
 
+    if return_error:
+        return list(centralDf.index), centralDf['error'].to_dict()
     return list(centralDf.index)
 
-def centroid_betweenness(fileList, communityAssignment, filtered_rmsd_matrix):
+def approximated(numMembers, pivots, cutoff):
+    # Whether centrality in a community of numMembers members is estimated from pivots sources
+    return pivots is not None and numMembers > pivots and (cutoff is None or numMembers > cutoff)
+
+def brandesUnitWeight(graph, sources, batch_size = None, linear_scaling = False):
+    # Brandes' accumulation on a graph of unit edge weights, for a batch of sources at a time. Searches from all sources of a
+    # batch advance one level at a time: path counts of the next level are the product of the graph with the counts of the
+    # current level, and dependencies are accumulated backward level by level in the same way
+    # linear_scaling: (Boolean) weight the dependency of node v on the path from s to t by 2 d(s, v) / d(s, t), see betweennessCentrality
+    # output: (numpy arrays) sums over sources of the dependency of each node and of its square
+    numNodes = graph.shape[0]
+    if batch_size is None:
+        batch_size = max(1, (1 << 22) // max(numNodes, 1))
+    betweenness = np.zeros(numNodes)
+    squares = np.zeros(numNodes)
+    for start in range(0, len(sources), batch_size):
+        batch = np.asarray(sources[start:start + batch_size])
+        columns = np.arange(len(batch))
+        sigma = np.zeros([numNodes, len(batch)])
+        sigma[batch, columns] = 1
+        depth = np.full([numNodes, len(batch)], -1)
+        depth[batch, columns] = 0
+        frontier = sigma.copy()
+        level = 0
+        while True:
+            paths = graph @ frontier
+            paths[depth >= 0] = 0
+            reached = paths > 0
+            if not reached.any():
+                break
+            level += 1
+            depth[reached] = level
+            sigma[reached] = paths[reached]
+            frontier = np.where(reached, paths, 0)
+        delta = np.zeros([numNodes, len(batch)])
+        for d in range(level, 0, -1):
+            # with linear scaling, delta holds the sum over targets of the path fractions divided by d(s, t)
+            target = 1 / d if linear_scaling else 1
+            coefficient = np.where(depth == d, (target + delta) / np.where(sigma > 0, sigma, 1), 0)
+            delta += np.where(depth == d - 1, sigma * (graph @ coefficient), 0)
+        delta[batch, columns] = 0
+        if linear_scaling:
+            delta *= 2 * np.maximum(depth, 0)
+        betweenness += delta.sum(axis = 1)
+        squares += np.square(delta).sum(axis = 1)
+    return betweenness, squares
+
+def brandesWeighted(graph, sources, linear_scaling = False):
+    # Brandes' accumulation with Dijkstra's algorithm on a binary heap, for graphs of arbitrary positive edge weights
+    numNodes = graph.shape[0]
+    indptr, indices, weights = graph.indptr, graph.indices, graph.data
+    betweenness = np.zeros(numNodes)
+    squares = np.zeros(numNodes)
+    for s in sources:
+        distance = np.full(numNodes, np.inf)
+        sigma = np.zeros(numNodes)
+        predecessors = [[] for x in range(numNodes)]
+        order = []
+        distance[s] = 0
+        sigma[s] = 1
+        heap = [(0.0, s)]
+        done = np.zeros(numNodes, dtype = bool)
+        while heap:
+            dv, v = heapq.heappop(heap)
+            if done[v]:
+                continue
+            done[v] = True
+            order.append(v)
+            for w, weight in zip(indices[indptr[v]:indptr[v + 1]], weights[indptr[v]:indptr[v + 1]]):
+                dw = dv + weight
+                if dw < distance[w] - 1e-12 * dw:
+                    distance[w] = dw
+                    sigma[w] = sigma[v]
+                    predecessors[w] = [v]
+                    heapq.heappush(heap, (dw, w))
+                elif abs(dw - distance[w]) <= 1e-12 * dw and not done[w]:
+                    sigma[w] += sigma[v]
+                    predecessors[w].append(v)
+        delta = np.zeros(numNodes)
+        for w in reversed(order):
+            target = 1 / distance[w] if linear_scaling and w != s else 1
+            for v in predecessors[w]:
+                delta[v] += sigma[v] / sigma[w] * (target + delta[w])
+        delta[s] = 0
+        if linear_scaling:
+            delta *= 2 * np.where(np.isfinite(distance), distance, 0)
+        betweenness += delta
+        squares += np.square(delta)
+    return betweenness, squares
+
+def betweennessCentrality(graph, pivots = None, seed = 0):
+    # Betweenness of each node of a CSR graph without self loops (sum over ordered pairs of nodes). Exact if pivots is None
+    # or at least the number of nodes. Otherwise estimated from the searches of pivots sources sampled without replacement
+    # (Brandes, U.; Pich, C. Int. J. Bifurcation Chaos 2007, 17, 2303), scaled to all sources. Sampled dependencies are linearly
+    # scaled (Geisberger, R.; Sanders, P.; Schultes, D. ALENEX 2008, 90): a path from s to t counts 2 d(s, v) / d(s, t) for each
+    # inner node v instead of 1. The sum over all sources is unchanged, but nodes next to a sampled source are not overestimated
+    # output: (numpy arrays) betweenness of each node and its standard error, from the variance of the dependencies over
+    #   the sampled sources with the finite population correction (0 when exact)
+    numNodes = graph.shape[0]
+    if pivots is None or pivots >= numNodes:
+        sources = np.arange(numNodes)
+    else:
+        sources = np.sort(np.random.default_rng(seed).choice(numNodes, pivots, replace = False))
+    numSources = len(sources)
+    if np.all(graph.data == 1):
+        betweenness, squares = brandesUnitWeight(graph, sources, linear_scaling = numSources < numNodes)
+    else:
+        betweenness, squares = brandesWeighted(graph, sources, linear_scaling = numSources < numNodes)
+    if numSources == numNodes or numSources < 2:
+        return betweenness, np.zeros(numNodes)
+    mean = betweenness / numSources
+    variance = np.maximum(squares / numSources - np.square(mean), 0) * numSources / (numSources - 1)
+    standardError = numNodes * np.sqrt(variance / numSources * (1 - numSources / numNodes))
+    return mean * numNodes, standardError
+
+def maximumNode(values, tolerance = 1e-9):
+    # Index of the largest value, the lowest index among values equal up to rounding
+    return int(np.flatnonzero(values >= values.max() - tolerance * abs(values.max()))[0])
+
+def betweennessCentroid(community_subgraph, pivots = None, seed = 0, cutoff = None):
+    # Index of the member of maximum betweenness and the relative standard error of its betweenness, see centroid_betweenness
+    sources = pivots if approximated(community_subgraph.shape[0], pivots, cutoff) else None
+    community_betweenness, standard_error = betweennessCentrality(community_subgraph, sources, seed)
+    # largest lower confidence bound, so that a member whose estimate rests on few sampled sources is not preferred
+    max_betweenness_index = maximumNode(community_betweenness - 2 * standard_error)
+    if standard_error[max_betweenness_index] > 0:
+        return max_betweenness_index, standard_error[max_betweenness_index] / community_betweenness[max_betweenness_index]
+    return max_betweenness_index, 0.0
+
+def centroid_betweenness(fileList, communityAssignment, filtered_rmsd_matrix, communityIndex = None, pivots = None, seed = 0, cutoff = None, return_error = False, n_jobs = 1):
     # Provided with list of conformers assigned to communities, choose representative centroid by conformers of maximum in community betweenness 
     # inputs
     # fileList: (list) names of xyz files for each conformer
     # communityAssignment: (list) list of community assignment correspoinding to the index of fileList
-    # filtered_rmsd_matrix: {np.array) RMSD matrix between conformers, except assigning distances above threshold to zero
-    numFiles = len(fileList)
-    communityList = list(set(communityAssignment))
-    centralNodes = []
-    comm_size = []
-    for C in communityList:
-        C_members = [x for x in range(numFiles) if communityAssignment[x] == C]
-        C_member_files = [fileList[x] for x in C_members]
-        comm_size.append(len(C_members))
-        community_subgraph = filtered_rmsd_matrix[C_members, :][:, C_members]
-        community_betweenness = np.zeros(len(C_members))
-        for i in range(len(C_member_files)):
-            record, lastnode = diekstra(community_subgraph, i)
-            for j in range(len(C_member_files)):
-                previous_node = lastnode[j]
-                while previous_node != -1:
-                    community_betweenness[previous_node] += 1
-                    previous_node = lastnode[previous_node]
-        max_betweenness_index = np.argmax(community_betweenness)
-        centralNodes.append(C_member_files[max_betweenness_index])
+    # filtered_rmsd_matrix: {np.array or scipy.sparse matrix) RMSD matrix between conformers, except assigning distances above threshold to zero
+    # communityIndex: (CommunityIndex) members of each community. Built from communityAssignment if not given
+    # pivots: (int) if given, estimate betweenness in communities larger than pivots (and than cutoff) from searches of pivots members sampled with seed
+    # seed: (int) seed of the sampled members. The same seed gives the same centroids
+    # cutoff: (int) number of members above which betweenness is estimated. None estimates it in all communities larger than pivots
+    # return_error: (Boolean) also return a dict of the relative standard error of the betweenness of each centroid (0 when exact)
+    # n_jobs: (int) number of processes selecting the centroids of different communities. -1 uses all cores
+    if communityIndex is None:
+        communityIndex = CommunityIndex(communityAssignment, fileList)
+    options = {'pivots': pivots, 'seed': seed, 'cutoff': cutoff}
+    results = selectPerCommunity(filtered_rmsd_matrix, communityIndex, betweennessCentroid, options, communityGraph, n_jobs)
+    centralNodes = [communityIndex.memberFiles(C)[i] for C, (i, error) in zip(communityIndex.communities, results)]
+    comm_size = list(communityIndex.sizes)
+    errors = [error for i, error in results]
 
     # Sort centers by size of clusters in descending order         
-    centralDf = pd.DataFrame({'size': comm_size}, index = centralNodes)
+    centralDf = pd.DataFrame({'size': comm_size, 'error': errors}, index = centralNodes)
     centralDf.sort_values(by = 'size', ascending = False, inplace = True)
 
+    if return_error:
+        return list(centralDf.index), centralDf['error'].to_dict()
     return list(centralDf.index)